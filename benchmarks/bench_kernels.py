@@ -14,12 +14,12 @@ from outlines_core.kernels.torch import (
 def generate_sparse_mask(batch, vocab, allowed_count=1000):
     mask_shape = (batch, (vocab + 31) // 32)
     mask = np.zeros(mask_shape, dtype=np.uint32)
-    allowed_indices = random.sample(range(vocab), allowed_count)
-    for idx in allowed_indices:
-        group = idx // 32
-        shift = idx % 32
-        bit_mask = np.uint32(1) << np.uint32(shift)
-        mask[0, group] |= bit_mask
+    allowed_indices = np.array(
+        random.sample(range(vocab), allowed_count), dtype=np.uint32
+    )
+    groups = allowed_indices >> 5
+    bit_masks = np.uint32(1) << (allowed_indices & np.uint32(31))
+    np.bitwise_or.at(mask[0], groups, bit_masks)
     return mask
 
 
@@ -70,9 +70,6 @@ class NumpyBitmaskApplyBenchmark:
 
         self.kernel = numpy_kernel
 
-        for _ in range(4):
-            self.kernel(self.logits, self.mask)
-
     def time_kernel(self, allowed_tokens, batch):
         self.kernel(self.logits, self.mask)
 
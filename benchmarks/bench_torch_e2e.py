@@ -1,31 +1,21 @@
 import torch
 
-from outlines_core import Guide, Index, Vocabulary
+from outlines_core import Guide
 from outlines_core.kernels.torch import (
     _apply_token_bitmask_inplace_kernel,
     allocate_token_bitmask,
+    fill_and_apply,
 )
 
-regex_samples = {
-    "email": r"[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*@(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?",
-    "complex_phone": "\\+?\\d{1,4}?[-.\\s]?\\(?\\d{1,3}?\\)?[-.\\s]?\\d{1,4}[-.\\s]?\\d{1,4}[-.\\s]?\\d{1,9}",
-    "simple_phone": "\\+?[1-9][0-9]{7,14}",
-    "date": r"([1-9]|0[1-9]|1[0-9]|2[0-9]|3[0-1])(\.|-|/)([1-9]|0[1-9]|1[0-2])(\.|-|/)([0-9][0-9]|19[0-9][0-9]|20[0-9][0-9])|([0-9][0-9]|19[0-9][0-9]|20[0-9][0-9])(\.|-|/)([1-9]|0[1-9]|1[0-2])(\.|-|/)([1-9]|0[1-9]|1[0-9]|2[0-9]|3[0-1])",
-    "time": r"(0?[1-9]|1[0-2]):[0-5]\d\s?(am|pm)?",
-    "ip": r"(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)",
-    "url": r"(https?:\/\/)?([\da-z\.-]+)\.([a-z\.]{2,6})([\/\w \.-]*)*\/?",
-    "ssn": r"\d{3}-\d{2}-\d{4}",
-    "complex_span_constrained_relation_extraction": "(['\"\\ ,]?((?:of|resulting|case|which|cultures|a|core|extreme|selflessness|spiritual|various|However|both|vary|in|other|secular|the|religious|among|moral|and|It|object|worldviews|altruism|traditional|material|aspect|or|life|beings|virtue|is|however|opposite|concern|an|practice|it|for|s|quality|religions|In|Altruism|animals|happiness|many|become|principle|human|selfishness|may|synonym)['\"\\ ,]?)+['\"\\ ,]?\\s\\|\\s([^|\\(\\)\n]{1,})\\s\\|\\s['\"\\ ,]?((?:of|resulting|case|which|cultures|a|core|extreme|selflessness|spiritual|various|However|both|vary|in|other|secular|the|religious|among|moral|and|It|object|worldviews|altruism|traditional|material|aspect|or|life|beings|virtue|is|however|opposite|concern|an|practice|it|for|s|quality|religions|In|Altruism|animals|happiness|many|become|principle|human|selfishness|may|synonym)['\"\\ ,]?)+['\"\\ ,]?(\\s\\|\\s\\(([^|\\(\\)\n]{1,})\\s\\|\\s([^|\\(\\)\n]{1,})\\))*\\n)*",
-}
+from .common import get_index, get_vocabulary, regex_samples
 
 
 class TorchE2EBenchmark:
     params = regex_samples.keys()
 
     def setup(self, pattern_name):
-        self.vocabulary = Vocabulary.from_pretrained("gpt2")
-        self.pattern = regex_samples[pattern_name]
-        self.guide = Guide(Index(self.pattern, self.vocabulary))
+        self.vocabulary = get_vocabulary()
+        self.guide = Guide(get_index(pattern_name))
 
         self.mask = allocate_token_bitmask(len(self.vocabulary))
         self.logits = torch.randn(1, len(self.vocabulary))
@@ -36,3 +26,6 @@ class TorchE2EBenchmark:
         )
 
         _apply_token_bitmask_inplace_kernel(self.logits, self.mask)
+
+    def time_fill_and_apply(self, pattern_name):
+        fill_and_apply(self.guide, self.logits)
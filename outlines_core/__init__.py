@@ -1 +1,2 @@
+from ._index_cache import IndexCache, get_or_build_index
 from .outlines_core import Guide, Index, Vocabulary
@@ -0,0 +1,96 @@
+"""Process-wide LRU cache of compiled `Index` objects."""
+import copy
+import threading
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from .outlines_core import Index, Vocabulary
+
+
+class IndexCache:
+    """
+    A thread-safe LRU cache of `Index` objects, keyed by the regex pattern and
+    the content of the vocabulary they were built from, so that equal
+    vocabularies (e.g. loaded twice from the same model) share their indexes.
+
+    Indexes are built outside of the lock, since `Index` construction releases
+    the GIL, so concurrent misses for different patterns build in parallel.
+
+    The hash of a vocabulary is cached until it is modified, and its snapshot
+    shares its tokens, so a hit for an unmodified vocabulary doesn't walk its
+    tokens.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        if maxsize < 1:
+            raise ValueError(
+                f"Invalid cache size: Expected maxsize >= 1, got {maxsize}."
+            )
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, int], Index]" = OrderedDict()
+        # One snapshot per distinct vocabulary content, shared by all of its
+        # entries: it tells hash collisions apart and, unlike the caller's
+        # vocabulary, it can't be modified in place.
+        self._vocabularies: Dict[int, Tuple[Vocabulary, int]] = {}
+
+    def get_or_build(self, pattern: str, vocabulary: Vocabulary) -> Index:
+        """
+        Returns the cached `Index` for `pattern` and `vocabulary`, building and
+        caching it on a miss.
+        """
+        vocabulary_hash = hash(vocabulary)
+        key = (pattern, vocabulary_hash)
+        with self._lock:
+            index = self._entries.get(key)
+            snapshot, count = self._vocabularies.get(vocabulary_hash, (None, 0))
+            if index is not None and snapshot == vocabulary:
+                # A copy shares the tokens of the vocabulary until either is
+                # modified, so with a copy of the caller's vocabulary as the
+                # snapshot, its next lookups compare equal by identity.
+                self._vocabularies[vocabulary_hash] = (copy.deepcopy(vocabulary), count)
+                self._entries.move_to_end(key)
+                return index
+
+        index = Index(pattern, vocabulary)
+
+        with self._lock:
+            snapshot, count = self._vocabularies.get(vocabulary_hash, (None, 0))
+            if snapshot is None:
+                snapshot = copy.deepcopy(vocabulary)
+            elif snapshot != vocabulary:
+                # Hash collision with a different vocabulary, don't cache.
+                return index
+            if key not in self._entries:
+                count += 1
+            self._vocabularies[vocabulary_hash] = (snapshot, count)
+            self._entries[key] = index
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                (_, evicted_hash), _ = self._entries.popitem(last=False)
+                snapshot, count = self._vocabularies[evicted_hash]
+                if count == 1:
+                    del self._vocabularies[evicted_hash]
+                else:
+                    self._vocabularies[evicted_hash] = (snapshot, count - 1)
+        return index
+
+    def clear(self) -> None:
+        """Removes all the cached indexes."""
+        with self._lock:
+            self._entries.clear()
+            self._vocabularies.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_default_cache = IndexCache()
+
+
+def get_or_build_index(pattern: str, vocabulary: Vocabulary) -> Index:
+    """
+    Returns an `Index` for `pattern` and `vocabulary` from the process-wide
+    cache, building it on a miss.
+    """
+    return _default_cache.get_or_build(pattern, vocabulary)
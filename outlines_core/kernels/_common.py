@@ -0,0 +1,65 @@
+from typing import Sequence, Tuple, Union
+
+from outlines_core import Guide
+
+# Bit patterns written by the native kernel into the disallowed logits, for the
+# dtypes it masks on their bits: -inf for half precision floats, and the
+# minimum for int8 (quantized) logits. float32 and float64 logits are set to -inf.
+FLOAT16_FILL = 0xFC00
+BFLOAT16_FILL = 0xFF80
+INT8_FILL = 0x80
+
+
+def check_mask_batch(
+    guide: Union[Guide, Sequence[Guide]], shape: Tuple[int, ...]
+) -> None:
+    """
+    Checks that a 2D mask of the given `shape` has one row per guide when `guide` is a
+    list of guides, and a single row otherwise.
+
+    Raises:
+        ValueError: If the number of rows doesn't match.
+    """
+    if isinstance(guide, (list, tuple)):
+        if shape[0] != len(guide):
+            raise ValueError(
+                f"Invalid batch size: Expected `mask.shape[0]` ({shape[0]}) to match the number of guides ({len(guide)})."
+            )
+    elif shape[0] != 1:
+        raise ValueError(
+            f"Invalid batch size: Batch mask writes are not supported for a single guide. Expected shape[0] == 1, but got shape {shape}."
+        )
+
+
+def write_mask(
+    guide: Union[Guide, Sequence[Guide]],
+    data_ptr: int,
+    numel: int,
+    element_size: int,
+) -> None:
+    """
+    Writes the bitmask of `guide`, or of each guide of a list into its own row, into the
+    mask buffer at `data_ptr`, with a single call into the native extension.
+    """
+    if isinstance(guide, (list, tuple)):
+        Guide.write_mask_into_batch(guide, data_ptr, numel, element_size)
+    else:
+        guide.write_mask_into(data_ptr, numel, element_size)
+
+
+def check_single_row_logits(ndim: int, shape: Tuple[int, ...]) -> None:
+    """
+    Checks that logits with `ndim` dimensions and the given `shape` are 1D, or 2D with
+    a single batch dimension.
+
+    Raises:
+        ValueError: If the logits have another number of dimensions or rows.
+    """
+    if ndim not in (1, 2):
+        raise ValueError(
+            f"Invalid logits dimensions: Expected a 1D or 2D array, but got {ndim}D."
+        )
+    elif ndim == 2 and shape[0] != 1:
+        raise ValueError(
+            f"Invalid batch size: Batch logits are not supported. Expected shape[0] == 1, but got shape {shape}."
+        )
@@ -1,4 +1,7 @@
+from typing import Callable, Sequence, Union
+
 from outlines_core import Guide
+from outlines_core.kernels._common import check_mask_batch, write_mask
 
 try:
     import mlx.core as mx
@@ -10,24 +13,44 @@ except ImportError as e:
     ) from e
 
 
-def allocate_token_bitmask(vocab_size: int) -> np.ndarray:
+def allocate_token_bitmask(vocab_size: int, batch: int = 1) -> np.ndarray:
     return np.full(
-        (1, (vocab_size + 31) // 32),
+        (batch, (vocab_size + 31) // 32),
         -1,
         dtype=np.int32,
     )
 
 
+# One thread per 32-token word of the mask: the mask word is loaded once for
+# its 32 logits, and fully allowed words are copied without per-bit tests.
+# `metal_kernel` outputs are fresh buffers, so every logit is written (copied
+# or set to -inf), there is no in-place variant.
 _KERNEL_SOURCE = r"""
 // Batch index
 uint batch = thread_position_in_grid.y;
-// Element index
-uint elem = thread_position_in_grid.x;
-
-uint bit = ((elem >> 5) < static_cast<uint>(mask_shape[1])) &&
-            ((mask[batch * mask_shape[1] + (elem >> 5)] >> (elem & 31)) & 1);
-
-out[batch * inp_shape[1] + elem] = bit ? inp[batch * inp_shape[1] + elem] : static_cast<T>(-INFINITY);
+// Mask word index
+uint word = thread_position_in_grid.x;
+
+uint vocab_size = static_cast<uint>(inp_shape[1]);
+uint base = word * 32;
+uint end = min(base + 32, vocab_size);
+uint row = batch * vocab_size;
+
+uint bits = word < static_cast<uint>(mask_shape[1])
+    ? static_cast<uint>(mask[batch * mask_shape[1] + word])
+    : 0u;
+
+if (bits == 0xFFFFFFFFu) {
+    for (uint elem = base; elem < end; ++elem) {
+        out[row + elem] = inp[row + elem];
+    }
+} else {
+    for (uint elem = base; elem < end; ++elem) {
+        out[row + elem] = ((bits >> (elem - base)) & 1)
+            ? inp[row + elem]
+            : static_cast<T>(-INFINITY);
+    }
+}
 """
 
 _KERNEL = mx.fast.metal_kernel(
@@ -43,14 +66,51 @@ def _apply_token_bitmask_kernel(data: mx.array, mask: mx.array) -> mx.array:
     return _KERNEL(
         inputs=[data, mask],
         template=[("T", data.dtype)],
-        grid=(data.shape[1], data.shape[0], 1),
+        grid=((data.shape[1] + 31) // 32, data.shape[0], 1),
         threadgroup=(256, 1, 1),
         output_shapes=[data.shape],
         output_dtypes=[data.dtype],
     )[0]
 
 
-def apply_token_bitmask(logits: mx.array, mask_np: np.ndarray) -> mx.array:
+def make_apply_kernel(
+    batch: int, vocab_size: int, dtype: mx.Dtype
+) -> Callable[[mx.array, mx.array], mx.array]:
+    """
+    Build a logits masking kernel specialized for a fixed logits shape and
+    dtype, for decoding loops in which they don't change between steps.
+
+    The launch parameters (grid, template and output shape) are computed once
+    here instead of on every call. The returned function takes the logits and
+    an `mx.array` mask and, like `apply_token_bitmask`, returns the masked
+    logits.
+
+    Arguments:
+        batch (int): The number of rows of the logits.
+        vocab_size (int): The number of columns of the logits.
+        dtype (mx.Dtype): The dtype of the logits.
+
+    Returns:
+        Callable[[mx.array, mx.array], mx.array]: The specialized kernel.
+    """
+    launch = dict(
+        template=[("T", dtype)],
+        grid=((vocab_size + 31) // 32, batch, 1),
+        threadgroup=(256, 1, 1),
+        output_shapes=[(batch, vocab_size)],
+        output_dtypes=[dtype],
+    )
+
+    @mx.compile
+    def apply(data: mx.array, mask: mx.array) -> mx.array:
+        return _KERNEL(inputs=[data, mask], **launch)[0]
+
+    return apply
+
+
+def apply_token_bitmask(
+    logits: mx.array, mask_np: Union[mx.array, np.ndarray]
+) -> mx.array:
     """
     Apply a logits bitmask inplace, setting the probability of invalid tokens
     to -infinity.
@@ -58,8 +118,9 @@ def apply_token_bitmask(logits: mx.array, mask_np: np.ndarray) -> mx.array:
     Arguments:
         logits (mx.array): The logits tensor.
 
-        mask (mx.array): The token bitmask representing the validity of each
-          token in the logits tensor.
+        mask_np (mx.array | np.ndarray): The token bitmask representing the validity
+          of each token in the logits tensor. An `mx.array` is used as is, a NumPy
+          array is copied into a new `mx.array`.
 
     Raises:
         ValueError: If any of the following conditions are not met:
@@ -71,8 +132,8 @@ def apply_token_bitmask(logits: mx.array, mask_np: np.ndarray) -> mx.array:
     Returns:
         None: Modifies the mask array in place.
     """
-    # makes a copy - non consuming
-    mask = mx.array(mask_np)
+    # The parameter keeps its original name, for callers passing it by keyword.
+    mask = mx.array(mask_np) if isinstance(mask_np, np.ndarray) else mask_np
 
     logits = logits if len(logits.shape) != 1 else mx.expand_dims(logits, axis=0)
     mask = mask if len(mask.shape) != 1 else mx.expand_dims(mask, axis=0)
@@ -96,7 +157,9 @@ def apply_token_bitmask(logits: mx.array, mask_np: np.ndarray) -> mx.array:
     return _apply_token_bitmask_kernel(logits, mask)
 
 
-def fill_next_token_bitmask(guide: Guide, mask: np.ndarray) -> None:
+def fill_next_token_bitmask(
+    guide: Union[Guide, Sequence[Guide]], mask: np.ndarray
+) -> None:
     """
     Writes a bitmask to represent the tokens permissible by the current state of the `guide`.
     Each bit in the bitmask corresponds to a token ID, with a bit value of 1 indicating that
@@ -104,21 +167,21 @@ def fill_next_token_bitmask(guide: Guide, mask: np.ndarray) -> None:
     the `mask` array in-place.
 
     Arguments:
-        guide (Guide): An instance of the `Guide` class that provides the current guidance state.
-        mask (torch.Tensor): A 2D tensor of type `torch.int32` where the bitmask will be written.
-                             The tensor must be contiguous, have a single batch dimension
-                             (shape[0] == 1), and reside on the CPU.
+        guide (Guide | Sequence[Guide]): An instance of the `Guide` class that provides the
+                                         current guidance state, or a list of them.
+        mask (np.ndarray): A 2D array of type `np.int32` where the bitmask will be written.
+                           The array must be C-contiguous, with a single row (shape[0] == 1),
+                           or one row per guide.
 
     Raises:
         ValueError: If any of the following conditions are not met:
                     - `mask.dtype` is not `np.int32`
-                    - `mask` is not a 2D tensor
-                    - `mask` does not have a single batch dimension (shape[0] != 1)
+                    - `mask` is not a 2D array
+                    - `mask` does not have one row per guide
                     - `mask` is not contiguous in memory
-                    - `mask` is not on the CPU device
 
     Returns:
-        None: Modifies the `mask` tensor in-place.
+        None: Modifies the `mask` array in-place.
     """
     if mask.dtype != np.int32:
         raise ValueError(
@@ -128,13 +191,10 @@ def fill_next_token_bitmask(guide: Guide, mask: np.ndarray) -> None:
         raise ValueError(
             f"Invalid mask dimensions: Expected a 2D array, but got {mask.ndim}D."
         )
-    elif mask.shape[0] != 1:
-        raise ValueError(
-            f"Invalid batch size: Batch mask writes are not supported. Expected shape[0] == 1, but got shape {mask.shape}."
-        )
-    elif not mask.flags["C_CONTIGUOUS"]:
+    check_mask_batch(guide, mask.shape)
+    if not mask.flags["C_CONTIGUOUS"]:
         raise ValueError(
             "Mask array must be contiguous in memory. Use `np.ascontiguousarray(mask)`."
         )
 
-    return guide.write_mask_into(mask.ctypes.data, mask.size, mask.itemsize)
+    write_mask(guide, mask.ctypes.data, mask.size, mask.itemsize)
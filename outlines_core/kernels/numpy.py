@@ -1,46 +1,97 @@
+from typing import Sequence, Union
+
 from outlines_core import Guide
+from outlines_core.kernels._common import (
+    FLOAT16_FILL,
+    INT8_FILL,
+    check_mask_batch,
+    check_single_row_logits,
+    write_mask,
+)
+from outlines_core.outlines_core import (
+    apply_token_bitmask_inplace as _apply_token_bitmask_inplace_ptr,
+)
 
 try:
-    import numba
     import numpy as np
 except ImportError as e:
-    missing_dep = "numba" if "numba" in str(e) else "numpy"
     raise ImportError(
-        f"To use the kernels in `outlines_core.kernels.numpy`, `{missing_dep}` must be installed. You can install it with `pip install {missing_dep}`"
+        "To use the kernels in `outlines_core.kernels.numpy`, `numpy` must be installed. You can install it with `pip install numpy`"
     ) from e
 
 
-def allocate_token_bitmask(vocab_size: int) -> np.ndarray:
+def allocate_token_bitmask(vocab_size: int, batch: int = 1) -> np.ndarray:
     return np.full(
-        (1, (vocab_size + 31) // 32),
+        (batch, (vocab_size + 31) // 32),
         -1,
         dtype=np.int32,
     )
 
 
-@numba.njit
-def _apply_token_bitmask_inplace_kernel(logits, mask):
-    mask_len = mask.shape[1]
-    cutoff = 32 * mask_len
+def _fill_value(dtype: np.dtype):
+    # Value of the disallowed logits: integer (quantized) logits have no -inf,
+    # their minimum is used instead.
+    return np.iinfo(dtype).min if np.issubdtype(dtype, np.integer) else -np.inf
+
 
+def _apply_token_bitmask_inplace_unpacked(logits: np.ndarray, mask: np.ndarray) -> None:
+    # NumPy implementation, used for logits the native kernel doesn't support
+    # (e.g. non-contiguous arrays). The mask is unpacked with NumPy's C loops,
+    # the writes stay in the logits dtype.
+    fill = _fill_value(logits.dtype)
+    cutoff = 32 * mask.shape[1]
     if logits.shape[1] > cutoff:
-        logits[:, cutoff:] = -np.inf
-        logits = logits[:, :cutoff]
+        logits[:, cutoff:] = fill
+
+    vocab_size = min(logits.shape[1], cutoff)
+    allowed = np.unpackbits(
+        np.ascontiguousarray(mask).view(np.uint8), axis=1, bitorder="little"
+    )[:, :vocab_size]
 
-    n_rows, n_cols = logits.shape
+    if logits.itemsize not in (1, 2, 4, 8):
+        # No unsigned integer has the size of the logits (e.g. `longdouble` or
+        # `complex128`), so they are masked by value.
+        np.putmask(logits[:, :vocab_size], allowed == 0, fill)
+        return
 
-    for i in range(n_rows):
-        for mi in range(mask_len):
-            mval = mask[i, mi]
-            base = mi * 32
-            for bit in range(32):
-                j = base + bit
+    # The logits are selected branch-free on their bit patterns, as
+    # `(bits & keep) | (fill & ~keep)` with `keep` all ones for allowed
+    # tokens. A masked `np.copyto` branches per element, which is an order of
+    # magnitude slower with unpredictable masks.
+    uint = np.dtype(f"u{logits.itemsize}")
+    bits = logits[:, :vocab_size].view(uint)
+    keep = np.negative(allowed, dtype=uint)
+    fill_bits = np.array(fill, dtype=logits.dtype).view(uint)
+    np.bitwise_and(bits, keep, out=bits)
+    np.bitwise_or(bits, np.bitwise_and(np.invert(keep), fill_bits), out=bits)
+
+
+def _apply_token_bitmask_inplace_kernel(logits: np.ndarray, mask: np.ndarray) -> None:
+    # Native implementation for aligned C-contiguous logits of the `_NATIVE_FILLS`
+    # dtypes, which picks the widest vector instructions the CPU supports at
+    # runtime (e.g. AVX-512 masked stores).
+    mask = np.require(mask, requirements=("C_CONTIGUOUS", "ALIGNED"))
+    _apply_token_bitmask_inplace_ptr(
+        logits.ctypes.data,
+        logits.size,
+        logits.itemsize,
+        mask.ctypes.data,
+        mask.size,
+        logits.shape[0],
+        _NATIVE_FILLS[logits.dtype],
+    )
 
-                if j >= n_cols:
-                    break
 
-                if ((mval >> bit) & 1) == 0:
-                    logits[i, j] = -np.inf
+# Dtypes the guide reads and writes directly.
+_NATIVE_DTYPES = (np.float32, np.float64)
+
+# Fill bit patterns of the dtypes masked by the native kernel.
+_NATIVE_FILLS = {
+    np.dtype(np.float32): None,
+    np.dtype(np.float64): None,
+    np.dtype(np.float16): FLOAT16_FILL,
+    np.dtype(np.int8): INT8_FILL,
+}
 
 
 def apply_token_bitmask_inplace(logits: np.ndarray, mask: np.ndarray) -> None:
@@ -49,7 +100,10 @@ def apply_token_bitmask_inplace(logits: np.ndarray, mask: np.ndarray) -> None:
     to -infinity.
 
     Arguments:
-        logits (np.ndarray): The logits tensor.
+        logits (np.ndarray): The logits tensor. Contiguous `float32`,
+          `float64`, `float16` and `int8` logits use the native kernel, other
+          logits are masked with NumPy. Invalid `int8` (quantized) logits are
+          set to -128.
 
         mask (np.ndarray): The token bitmask representing the validity of each
           token in the logits tensor.
@@ -83,10 +137,21 @@ def apply_token_bitmask_inplace(logits: np.ndarray, mask: np.ndarray) -> None:
         raise ValueError(
             f"Invalid batch size: Expected `mask.shape[0]` ({mask.shape[0]}) to match `logits.shape[0]` ({logits.shape[0]})."
         )
-    _apply_token_bitmask_inplace_kernel(logits, mask)
+
+    if (
+        logits.dtype in _NATIVE_FILLS
+        and logits.size > 0
+        and logits.flags["C_CONTIGUOUS"]
+        and logits.flags["ALIGNED"]
+    ):
+        _apply_token_bitmask_inplace_kernel(logits, mask)
+    else:
+        _apply_token_bitmask_inplace_unpacked(logits, mask)
 
 
-def fill_next_token_bitmask(guide: Guide, mask: np.ndarray) -> None:
+def fill_next_token_bitmask(
+    guide: Union[Guide, Sequence[Guide]], mask: np.ndarray
+) -> None:
     """
     Writes a bitmask to represent the tokens permissible by the current state of the `guide`.
     Each bit in the bitmask corresponds to a token ID, with a bit value of 1 indicating that
@@ -94,18 +159,18 @@ def fill_next_token_bitmask(guide: Guide, mask: np.ndarray) -> None:
     the `mask` array in-place.
 
     Arguments:
-        guide (Guide): An instance of the `Guide` class that provides the current guidance state.
-        mask (np.ndarray): A 2D tensor of type `torch.int32` where the bitmask will be written.
-                             The tensor must be contiguous, have a single batch dimension
-                             (shape[0] == 1), and reside on the CPU.
+        guide (Guide | Sequence[Guide]): An instance of the `Guide` class that provides the
+                                         current guidance state, or a list of them.
+        mask (np.ndarray): A 2D array of type `np.int32` where the bitmask will be written.
+                           The array must be C-contiguous, with a single row (shape[0] == 1),
+                           or one row per guide.
 
     Raises:
         ValueError: If any of the following conditions are not met:
-                    - `mask.dtype` is not `torch.int32`
-                    - `mask` is not a 2D tensor
-                    - `mask` does not have a single batch dimension (shape[0] != 1)
+                    - `mask.dtype` is not `np.int32`
+                    - `mask` is not a 2D array
+                    - `mask` does not have one row per guide
                     - `mask` is not contiguous in memory
-                    - `mask` is not on the CPU device
 
     Returns:
         None: Modifies the `mask` array in-place.
@@ -118,13 +183,84 @@ def fill_next_token_bitmask(guide: Guide, mask: np.ndarray) -> None:
         raise ValueError(
             f"Invalid mask dimensions: Expected a 2D array, but got {mask.ndim}D."
         )
-    elif mask.shape[0] != 1:
+    check_mask_batch(guide, mask.shape)
+    if not mask.flags["C_CONTIGUOUS"]:
+        raise ValueError(
+            "Mask array must be contiguous in memory. Use `np.ascontiguousarray(mask)`."
+        )
+
+    write_mask(guide, mask.ctypes.data, mask.size, mask.itemsize)
+
+
+def fill_and_apply(guide: Guide, logits: np.ndarray) -> None:
+    """
+    Sets the logits of the tokens not permitted by the current state of the `guide` to
+    -infinity, in place, like `fill_next_token_bitmask` followed by `apply_token_bitmask_inplace`.
+    Aligned C-contiguous `float32` / `float64` logits are written directly by the guide,
+    without a bitmask.
+
+    Arguments:
+        guide (Guide): An instance of the `Guide` class that provides the current guidance state.
+        logits (np.ndarray): The logits array, either 1D or 2D with a single batch dimension.
+
+    Raises:
+        ValueError: If `logits` is not 1D or 2D with a single batch dimension.
+
+    Returns:
+        None: Modifies the `logits` array in-place.
+    """
+    check_single_row_logits(logits.ndim, logits.shape)
+
+    if (
+        logits.dtype in _NATIVE_DTYPES
+        and logits.flags["C_CONTIGUOUS"]
+        and logits.flags["ALIGNED"]
+    ):
+        guide.mask_logits_into(logits.ctypes.data, logits.size, logits.itemsize)
+        return
+
+    vocab_size = logits.shape[-1]
+    mask = allocate_token_bitmask(vocab_size)
+    fill_next_token_bitmask(guide, mask)
+    apply_token_bitmask_inplace(logits.reshape(1, vocab_size), mask)
+
+
+def sample_next_token(guide: Guide, probs: np.ndarray, rng: np.random.Generator) -> int:
+    """
+    Samples the next token among the tokens permitted by the current state of the `guide`,
+    with a probability proportional to `probs`, without advancing the guide. This is
+    equivalent to masking `probs`, renormalizing them and sampling with `rng.choice`, but
+    the allowed tokens are walked directly by the guide, and no mask or copy of `probs` is
+    made. A single number is drawn from `rng`, so sampling is reproducible with a seeded `rng`.
+
+    Arguments:
+        guide (Guide): An instance of the `Guide` class that provides the current guidance state.
+        probs (np.ndarray): The contiguous 1D array of non-negative `float32` / `float64`
+                            weights (e.g. probabilities) of the tokens of the vocabulary.
+        rng (np.random.Generator): The random generator used for sampling.
+
+    Raises:
+        ValueError: If any of the following conditions are not met:
+                    - `probs` is a contiguous 1D array
+                    - `probs` is of type `float32` or `float64`
+                    - an allowed token has a positive weight
+
+    Returns:
+        int: The sampled token id.
+    """
+    if probs.ndim != 1:
+        raise ValueError(
+            f"Invalid probabilities dimensions: Expected a 1D array, but got {probs.ndim}D."
+        )
+    elif probs.dtype not in _NATIVE_DTYPES:
         raise ValueError(
-            f"Invalid batch size: Batch mask writes are not supported. Expected shape[0] == 1, but got shape {mask.shape}."
+            f"Invalid probabilities dtype: Expected float32 or float64, but got {probs.dtype}."
         )
-    elif not mask.flags["C_CONTIGUOUS"]:
+    elif not probs.flags["C_CONTIGUOUS"]:
         raise ValueError(
-            "Mask array must be contiguous in memory. Use `np.ascontiguousarray(mask)`."
+            "Probabilities array must be contiguous in memory. Use `np.ascontiguousarray(probs)`."
         )
 
-    return guide.write_mask_into(mask.ctypes.data, mask.size, mask.itemsize)
+    return guide.sample_next_token(
+        probs.ctypes.data, probs.size, probs.itemsize, rng.random()
+    )
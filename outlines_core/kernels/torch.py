@@ -3,7 +3,22 @@
 # which it writes into a tensor.
 #
 # Kernels inspired by https://github.com/guidance-ai/llguidance/blob/main/python/llguidance/torch.py
+import functools
+import warnings
+from typing import Optional, Sequence, Union
+
 from outlines_core import Guide
+from outlines_core.kernels._common import (
+    BFLOAT16_FILL,
+    FLOAT16_FILL,
+    INT8_FILL,
+    check_mask_batch,
+    check_single_row_logits,
+    write_mask,
+)
+from outlines_core.outlines_core import (
+    apply_token_bitmask_inplace as _apply_token_bitmask_inplace_ptr,
+)
 
 try:
     import torch
@@ -15,18 +30,22 @@ except Exception as e:
     ) from e
 
 
-def allocate_token_bitmask(vocab_size: int) -> torch.Tensor:
+def allocate_token_bitmask(vocab_size: int, batch: int = 1) -> torch.Tensor:
     """
     Allocate a token bitmask for use with the `Guide.write_into_mask` API and logits masking,
     based on the vocab_size.
 
+    The rows of a batched bitmask are contiguous, so the whole batch can be filled
+    with a single `Guide.write_mask_into_batch` call.
+
     Arguments:
         - vocab_size: int
+        - batch: int, the number of rows of the bitmask
     Returns:
         -  torch.Tensor
     """
     return torch.full(
-        (1, (vocab_size + 31) // 32),
+        (batch, (vocab_size + 31) // 32),
         -1,
         dtype=torch.int32,
         pin_memory=torch.cuda.is_available(),
@@ -43,12 +62,25 @@ def allocate_token_bitmask(vocab_size: int) -> torch.Tensor:
 @torch.compile(dynamic=True)
 def _apply_token_bitmask_inplace_kernel(logits, mask):
     # This will set any logits beyond the mask
-    # to -torch.inf
+    # to -torch.inf. Masks are normally sized to the logits, in which case
+    # there is nothing past the cutoff and the store is skipped.
+    # Integer (quantized) logits have no -inf, their minimum is used instead.
+    fill = -torch.inf if logits.is_floating_point() else torch.iinfo(logits.dtype).min
     cutoff = 32 * mask.shape[1]
-    logits[:, cutoff:] = -torch.inf
+    if logits.shape[1] > cutoff:
+        logits[:, cutoff:] = fill
 
-    # Unpack mask so each bit is a boolean
-    bit_masks = (
+    # Unpack mask so each bit is compared in place. Under `torch.compile` this
+    # broadcast is fused into the masked fill, so the (batch, 32 * mask_len)
+    # intermediate is never materialized. The fill is bounded by the number of
+    # tokens covered by both tensors, so wider logits (already handled above)
+    # don't overrun the unpacked mask.
+    vocab_size = min(logits.shape[1], cutoff)
+    # The bit offsets are deliberately built inline: Inductor folds the
+    # `arange` into the index expression, so nothing is allocated per call.
+    # Passing a cached tensor instead turns it into a memory load and makes
+    # the kernel ~10x slower on CPU.
+    allowed = (
         (
             torch.bitwise_right_shift(
                 mask.unsqueeze(-1),
@@ -56,12 +88,160 @@ def _apply_token_bitmask_inplace_kernel(logits, mask):
             )
             & 1
         )
-        .bool()
         .view(mask.shape[0], -1)
-        .narrow(1, 0, logits.shape[1])
+        .narrow(1, 0, vocab_size)
+    )
+
+    logits[:, :vocab_size].masked_fill_(allowed == 0, fill)
+
+
+# Each thread handles 4 consecutive tokens of a row, which share a mask word: it
+# reads the word once, returns early when the 4 tokens are all allowed (the
+# common case with a permissive state), and otherwise writes -inf into the
+# logits of the disallowed ones, so no intermediate tensor is allocated.
+# Compiled on first use for CUDA logits, or by `load_cuda_kernel`.
+_CUDA_KERNEL_SOURCE = r"""
+#include <cmath>
+#include <torch/extension.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <c10/cuda/CUDAGuard.h>
+
+constexpr int kTokensPerThread = 4;
+
+template <typename T>
+__global__ void apply_token_bitmask_inplace_kernel(
+    T* __restrict__ logits,
+    const int32_t* __restrict__ mask,
+    const int64_t vocab_size,
+    const int64_t mask_len,
+    const int64_t logits_stride,
+    const int64_t mask_stride
+) {
+    const int64_t batch = blockIdx.y;
+    const int64_t first =
+        (static_cast<int64_t>(blockIdx.x) * blockDim.x + threadIdx.x) * kTokensPerThread;
+    if (first >= vocab_size) {
+        return;
+    }
+    const int64_t word = first >> 5;
+    const uint32_t bits = word < mask_len
+        ? static_cast<uint32_t>(mask[batch * mask_stride + word]) >> (first & 31)
+        : 0u;
+    if ((bits & 0xFu) == 0xFu) {
+        return;
+    }
+    T* row = logits + batch * logits_stride;
+    #pragma unroll
+    for (int i = 0; i < kTokensPerThread; ++i) {
+        if (first + i < vocab_size && !((bits >> i) & 1u)) {
+            row[first + i] = static_cast<T>(-INFINITY);
+        }
+    }
+}
+
+void apply_token_bitmask_inplace(torch::Tensor logits, torch::Tensor mask) {
+    const at::cuda::OptionalCUDAGuard device_guard(logits.device());
+    const int64_t batch = logits.size(0);
+    const int64_t vocab_size = logits.size(1);
+    const int threads = 256;
+    const int64_t tokens_per_block = threads * kTokensPerThread;
+    const dim3 blocks((vocab_size + tokens_per_block - 1) / tokens_per_block, batch);
+    auto cuda_stream = at::cuda::getCurrentCUDAStream();
+
+    AT_DISPATCH_FLOATING_TYPES_AND2(
+        at::ScalarType::Half,
+        at::ScalarType::BFloat16,
+        logits.scalar_type(),
+        "apply_token_bitmask_inplace",
+        [&] {
+            apply_token_bitmask_inplace_kernel<scalar_t><<<blocks, threads, 0, cuda_stream>>>(
+                logits.data_ptr<scalar_t>(),
+                mask.data_ptr<int32_t>(),
+                vocab_size,
+                mask.size(1),
+                logits.stride(0),
+                mask.stride(0)
+            );
+        }
+    );
+}
+"""
+
+
+@functools.lru_cache(maxsize=None)
+def _load_cuda_kernel():
+    """
+    Compiles the CUDA bitmask kernel, returns `None` if it can't be built
+    (e.g. no CUDA toolkit available), in which case the compiled torch kernel
+    is used instead, with a warning giving the error.
+    """
+    try:
+        from torch.utils.cpp_extension import load_inline
+
+        return load_inline(
+            name="outlines_core_bitmask",
+            cpp_sources=[
+                "void apply_token_bitmask_inplace(torch::Tensor logits, torch::Tensor mask);"
+            ],
+            cuda_sources=[_CUDA_KERNEL_SOURCE],
+            functions=["apply_token_bitmask_inplace"],
+        )
+    except Exception as e:
+        warnings.warn(
+            f"The CUDA bitmask kernel could not be built, the compiled torch kernel is used instead: {e}",
+            RuntimeWarning,
+        )
+        return None
+
+
+def load_cuda_kernel() -> bool:
+    """
+    Compiles the CUDA bitmask kernel ahead of time. Otherwise, it is compiled by the first
+    `apply_token_bitmask_inplace` call with CUDA logits, which can then take tens of seconds
+    (the build is cached by torch across processes).
+
+    Returns:
+        bool: Whether the kernel is available, the compiled torch kernel is used otherwise.
+    """
+    return _load_cuda_kernel() is not None
+
+
+def _use_cuda_kernel(logits: torch.Tensor, mask: torch.Tensor) -> bool:
+    return (
+        logits.is_cuda
+        and logits.is_floating_point()
+        # An empty grid is an invalid launch configuration.
+        and logits.numel() > 0
+        and mask.device == logits.device
+        and logits.stride(1) == 1
+        and mask.stride(1) == 1
+        and _load_cuda_kernel() is not None
     )
 
-    logits.masked_fill_(~bit_masks, -torch.inf)
+
+# Fill bit patterns of the dtypes masked by the native kernel on CPU.
+_NATIVE_FILLS = {
+    torch.float32: None,
+    torch.float64: None,
+    torch.float16: FLOAT16_FILL,
+    torch.bfloat16: BFLOAT16_FILL,
+    torch.int8: INT8_FILL,
+}
+
+
+def _use_native_kernel(logits: torch.Tensor, mask: torch.Tensor) -> bool:
+    return (
+        logits.device.type == "cpu"
+        and mask.device.type == "cpu"
+        and logits.dtype in _NATIVE_FILLS
+        and logits.numel() > 0
+        and logits.is_contiguous()
+        and mask.is_contiguous()
+        # Tensors viewing a buffer at an offset (e.g. `torch.frombuffer`) may
+        # be unaligned, which the native kernel rejects.
+        and logits.data_ptr() % logits.element_size() == 0
+        and mask.data_ptr() % mask.element_size() == 0
+    )
 
 
 def apply_token_bitmask_inplace(logits: torch.Tensor, mask: torch.Tensor) -> None:
@@ -70,7 +250,11 @@ def apply_token_bitmask_inplace(logits: torch.Tensor, mask: torch.Tensor) -> Non
     to -infinity.
 
     Arguments:
-        logits (torch.Tensor): The logits tensor.
+        logits (torch.Tensor): The logits tensor. Contiguous CPU `float32`,
+          `float64`, `float16`, `bfloat16` and `int8` logits use the native
+          kernel. Invalid `int8` (quantized) logits are set to -128. Floating
+          point CUDA logits use a CUDA kernel, compiled by the first call unless
+          `load_cuda_kernel` was called.
 
         mask (torch.Tensor): The token bitmask representing the validity of
           each token in the logits tensor.
@@ -101,10 +285,28 @@ def apply_token_bitmask_inplace(logits: torch.Tensor, mask: torch.Tensor) -> Non
         raise ValueError(
             f"Invalid batch size: Expected `mask.shape[0]` ({mask.shape[0]}) to match `logits.shape[0]` ({logits.shape[0]})."
         )
-    _apply_token_bitmask_inplace_kernel(logits, mask)
+
+    if _use_cuda_kernel(logits, mask):
+        _load_cuda_kernel().apply_token_bitmask_inplace(logits, mask)
+    elif _use_native_kernel(logits, mask):
+        # Skips the mask words in which every token is allowed, without touching
+        # their logits.
+        _apply_token_bitmask_inplace_ptr(
+            logits.data_ptr(),
+            logits.numel(),
+            logits.element_size(),
+            mask.data_ptr(),
+            mask.numel(),
+            logits.shape[0],
+            _NATIVE_FILLS[logits.dtype],
+        )
+    else:
+        _apply_token_bitmask_inplace_kernel(logits, mask)
 
 
-def fill_next_token_bitmask(guide: Guide, mask: torch.Tensor) -> None:
+def fill_next_token_bitmask(
+    guide: Union[Guide, Sequence[Guide]], mask: torch.Tensor
+) -> None:
     """
     Writes a bitmask to represent the tokens permissible by the current state of the `guide`.
     Each bit in the bitmask corresponds to a token ID, with a bit value of 1 indicating that
@@ -112,16 +314,17 @@ def fill_next_token_bitmask(guide: Guide, mask: torch.Tensor) -> None:
     the `mask` tensor in-place.
 
     Arguments:
-        guide (Guide): An instance of the `Guide` class that provides the current guidance state.
+        guide (Guide | Sequence[Guide]): An instance of the `Guide` class that provides the
+                                         current guidance state, or a list of them.
         mask (torch.Tensor): A 2D tensor of type `torch.int32` where the bitmask will be written.
                              The tensor must be contiguous, have a single batch dimension
-                             (shape[0] == 1), and reside on the CPU.
+                             (shape[0] == 1), or one per guide, and reside on the CPU.
 
     Raises:
         ValueError: If any of the following conditions are not met:
                     - `mask.dtype` is not `torch.int32`
                     - `mask` is not a 2D tensor
-                    - `mask` does not have a single batch dimension (shape[0] != 1)
+                    - `mask` does not have one batch dimension per guide
                     - `mask` is not contiguous in memory
                     - `mask` is not on the CPU device
 
@@ -136,11 +339,8 @@ def fill_next_token_bitmask(guide: Guide, mask: torch.Tensor) -> None:
         raise ValueError(
             f"Invalid mask dimensions: Expected a 2D array, but got {mask.dim()}D."
         )
-    elif mask.shape[0] != 1:
-        raise ValueError(
-            f"Invalid batch size: Batch mask writes are not supported. Expected shape[0] == 1, but got shape {mask.shape}."
-        )
-    elif not mask.is_contiguous():
+    check_mask_batch(guide, mask.shape)
+    if not mask.is_contiguous():
         raise ValueError(
             "Mask array must be contiguous in memory. Use `mask.contiguous()` to fix it."
         )
@@ -149,4 +349,83 @@ def fill_next_token_bitmask(guide: Guide, mask: torch.Tensor) -> None:
             f"Invalid device: Expected `mask` tensor to be on device `cpu`, but found it on `{mask.device}`."
         )
 
-    guide.write_mask_into(mask.data_ptr(), mask.numel(), mask.element_size())
+    write_mask(guide, mask.data_ptr(), mask.numel(), mask.element_size())
+
+
+def fill_next_token_bitmask_and_upload(
+    guide: Guide,
+    mask: torch.Tensor,
+    device_mask: torch.Tensor,
+    stream: Optional["torch.cuda.Stream"] = None,
+) -> None:
+    """
+    Writes the bitmask of the tokens permissible by the current state of the `guide` into
+    the host `mask`, then schedules an asynchronous copy of it into `device_mask`.
+
+    The copy only overlaps with the rest of the decoding step when `mask` is in pinned memory,
+    which is the case for tensors returned by `allocate_token_bitmask` when CUDA is available.
+    The caller is responsible for synchronizing `stream` before the next write into `mask`
+    and before `device_mask` is consumed on another stream, for example with
+    `torch.cuda.current_stream().wait_stream(stream)`.
+
+    Arguments:
+        guide (Guide): An instance of the `Guide` class that provides the current guidance state.
+        mask (torch.Tensor): A 2D host tensor of type `torch.int32`, with the same constraints
+                             as in `fill_next_token_bitmask`.
+        device_mask (torch.Tensor): A tensor of the same shape and dtype as `mask` residing on
+                                    the device of the logits, it receives the uploaded bitmask.
+        stream (torch.cuda.Stream, optional): The stream on which the copy is scheduled,
+                                              the current stream is used if not provided.
+
+    Raises:
+        ValueError: If `mask` doesn't satisfy the conditions of `fill_next_token_bitmask`, or if
+                    `device_mask` does not match the shape and dtype of `mask`.
+
+    Returns:
+        None: Modifies the `mask` and `device_mask` tensors in-place.
+    """
+    if device_mask.shape != mask.shape or device_mask.dtype != mask.dtype:
+        raise ValueError(
+            f"Invalid device mask: Expected shape {mask.shape} and dtype `{mask.dtype}`, but got shape {device_mask.shape} and dtype `{device_mask.dtype}`."
+        )
+
+    fill_next_token_bitmask(guide, mask)
+
+    with torch.cuda.stream(stream):
+        device_mask.copy_(mask, non_blocking=True)
+
+
+def fill_and_apply(guide: Guide, logits: torch.Tensor) -> None:
+    """
+    Sets the logits of the tokens not permitted by the current state of the `guide` to
+    -infinity, in place, like `fill_next_token_bitmask` followed by `apply_token_bitmask_inplace`.
+    Aligned contiguous `float32` / `float64` CPU logits are written directly by the guide;
+    other logits (e.g. on GPU, or half precision) go through a bitmask.
+
+    Arguments:
+        guide (Guide): An instance of the `Guide` class that provides the current guidance state.
+        logits (torch.Tensor): The logits tensor, either 1D or 2D with a single batch dimension.
+
+    Raises:
+        ValueError: If `logits` is not 1D or 2D with a single batch dimension.
+
+    Returns:
+        None: Modifies the `logits` tensor in-place.
+    """
+    check_single_row_logits(logits.dim(), logits.shape)
+
+    if (
+        logits.device.type == "cpu"
+        and logits.dtype in (torch.float32, torch.float64)
+        and logits.is_contiguous()
+        and logits.data_ptr() % logits.element_size() == 0
+    ):
+        guide.mask_logits_into(logits.data_ptr(), logits.numel(), logits.element_size())
+        return
+
+    vocab_size = logits.shape[-1]
+    mask = allocate_token_bitmask(vocab_size)
+    fill_next_token_bitmask(guide, mask)
+    apply_token_bitmask_inplace(
+        logits.view(1, vocab_size), mask.to(logits.device, non_blocking=True)
+    )
@@ -0,0 +1,77 @@
+//! A bounded in-memory cache, for the memoized values shared across calls.
+
+use std::borrow::Borrow;
+use std::collections::VecDeque;
+use std::hash::Hash;
+
+use rustc_hash::FxHashMap as HashMap;
+
+/// A map holding at most `capacity` entries, which evicts its oldest entry to make room for a
+/// new one.
+pub(crate) struct FifoCache<K, V> {
+    capacity: usize,
+    entries: HashMap<K, V>,
+    /// The keys of `entries`, from the oldest to the most recently inserted.
+    order: VecDeque<K>,
+}
+
+impl<K: Clone + Eq + Hash, V> FifoCache<K, V> {
+    pub(crate) fn new(capacity: usize) -> Self {
+        Self {
+            capacity,
+            entries: HashMap::default(),
+            order: VecDeque::with_capacity(capacity),
+        }
+    }
+
+    pub(crate) fn get<Q>(&self, key: &Q) -> Option<&V>
+    where
+        K: Borrow<Q>,
+        Q: Eq + Hash + ?Sized,
+    {
+        self.entries.get(key)
+    }
+
+    /// Inserts `value` under `key`, evicting the oldest entry if the cache is full. The value
+    /// of a key already present is replaced, without changing its age.
+    pub(crate) fn insert(&mut self, key: K, value: V) {
+        if let Some(entry) = self.entries.get_mut(&key) {
+            *entry = value;
+            return;
+        }
+        if self.order.len() >= self.capacity {
+            if let Some(oldest) = self.order.pop_front() {
+                self.entries.remove(&oldest);
+            }
+        }
+        self.order.push_back(key.clone());
+        self.entries.insert(key, value);
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn evicts_oldest_past_capacity() {
+        let mut cache = FifoCache::new(3);
+        for i in 0..3 {
+            cache.insert(i.to_string(), i);
+        }
+        // Replacing a value doesn't evict anything.
+        cache.insert("0".to_string(), 10);
+        assert_eq!(cache.get("0"), Some(&10));
+        assert_eq!(cache.get("2"), Some(&2));
+
+        for i in 3..5 {
+            cache.insert(i.to_string(), i);
+        }
+        assert_eq!(cache.entries.len(), 3);
+        assert_eq!(cache.get("0"), None);
+        assert_eq!(cache.get("1"), None);
+        for i in 2..5 {
+            assert_eq!(cache.get(i.to_string().as_str()), Some(&i));
+        }
+    }
+}
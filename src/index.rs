@@ -1,25 +1,76 @@
 //! Building an `Index` to efficiently map vocabulary tokens to state transitions.
 
+use std::sync::{Arc, Mutex};
+
+use bincode::de::Decoder;
+use bincode::enc::Encoder;
+use bincode::error::{DecodeError, EncodeError};
 use bincode::{Decode, Encode};
+use once_cell::sync::Lazy;
 use regex_automata::dfa::dense::DFA;
-use regex_automata::dfa::Automaton;
+use regex_automata::dfa::{Automaton, StartKind};
 use regex_automata::util::primitives::StateID as AutomataStateId;
 use regex_automata::Anchored;
 use rustc_hash::{FxHashMap as HashMap, FxHashSet as HashSet};
 
+use crate::fifo_cache::FifoCache;
 use crate::prelude::*;
 use crate::vocabulary::Vocabulary;
 use crate::{Error, Result};
 
+/// The maximum number of compiled automata kept by `compiled_dfa`.
+const DFA_CACHE_SIZE: usize = 64;
+
+/// Automata compiled from regular expressions, keyed by the regular expression.
+static DFAS: Lazy<Mutex<FifoCache<String, Arc<DFA<Vec<u32>>>>>> =
+    Lazy::new(|| Mutex::new(FifoCache::new(DFA_CACHE_SIZE)));
+
+/// Returns the automaton of `regex`, compiling it only if it isn't one of the recently compiled
+/// ones. The same patterns, e.g. those of JSON schema types, are often indexed over and over
+/// with different vocabularies.
+fn compiled_dfa(regex: &str) -> Result<Arc<DFA<Vec<u32>>>> {
+    if let Some(dfa) = DFAS.lock().ok().and_then(|dfas| dfas.get(regex).cloned()) {
+        return Ok(dfa);
+    }
+    // Only anchored searches are run, so the unanchored start states, and the states only
+    // reachable from them, aren't built.
+    let dfa = Arc::new(
+        DFA::builder()
+            .configure(DFA::config().start_kind(StartKind::Anchored))
+            .build(regex)
+            .map_err(Box::new)?,
+    );
+    if let Ok(mut dfas) = DFAS.lock() {
+        dfas.insert(regex.to_string(), Arc::clone(&dfa));
+    }
+    Ok(dfa)
+}
+
+/// A cache line of mask words, so that the rows of `Index::masks` are aligned to 64 bytes.
+#[derive(Clone, Copy, Debug, PartialEq, Eq)]
+#[repr(C, align(64))]
+struct MaskBlock([u32; MaskBlock::WORDS]);
+
+impl MaskBlock {
+    const WORDS: usize = 16;
+}
+
 /// `Index` efficiently maps vocabulary tokens to state transitions.
-#[derive(Clone, Debug, PartialEq, Encode, Decode)]
+#[derive(Clone, Debug, PartialEq, Eq)]
 pub struct Index {
     /// The ID of the initial state in the automaton, processing begins from this state.
     initial_state: StateId,
-    /// A collection of states considered as terminal states.
-    final_states: HashSet<StateId>,
+    /// The tokens allowed in the initial state, which every `Guide` starts from.
+    initial_tokens: Vec<TokenId>,
+    /// A bitset of the states considered as terminal states, in which bit `i % 64` of word
+    /// `i / 64` is set for the state `i << stride2`.
+    final_states: Vec<u64>,
     /// A mapping of state transitions, defined by tokens ids and their corresponding state changes.
     ///
+    /// State IDs are premultiplied by the stride of the automaton, `1 << stride2`, so the
+    /// transitions of a state are stored at index `state >> stride2`, with an empty map for
+    /// states without transitions. `transitions()` gives the sparse mapping below.
+    ///
     /// ### Example
     /// ```ignore
     /// transitions = {
@@ -52,7 +103,21 @@ pub struct Index {
     ///  |             Final state              |
     ///  +--------------------------------------+
     /// ```
-    transitions: HashMap<StateId, HashMap<TokenId, StateId>>,
+    transitions: Vec<HashMap<TokenId, StateId>>,
+    /// The log2 of the stride by which state IDs are premultiplied.
+    stride2: usize,
+    /// Bitmasks of the tokens allowed in each state, as rows of `mask_words` words in which bit
+    /// `token_id % 32` of word `token_id / 32` is set for every allowed token. States with the
+    /// same allowed tokens share a row. Rows are padded to whole cache lines, so that copying
+    /// one reads aligned, full lines.
+    ///
+    /// Each distinct set of allowed tokens costs `vocab_size / 8` bytes rounded up to 64, e.g.
+    /// 16 KB with 128k tokens. The masks aren't encoded, they are rebuilt from `transitions`.
+    masks: Vec<MaskBlock>,
+    /// The row in `masks` of each state, indexed like `transitions`.
+    mask_rows: Vec<u32>,
+    /// The number of words in a row of `masks`, enough for the largest allowed token ID.
+    mask_words: usize,
     /// The token ID reserved for the "end-of-sequence" token.
     eos_token_id: TokenId,
     /// The size of the vocabulary used to build the index.
@@ -103,15 +168,33 @@ impl Index {
     pub fn new(regex: &str, vocabulary: &Vocabulary) -> Result<Self> {
         let vocab_size = vocabulary.len();
         let eos_token_id = vocabulary.eos_token_id();
-        let dfa = DFA::new(regex).map_err(Box::new)?;
+        let dfa = compiled_dfa(regex)?;
         let start_state = match dfa.universal_start_state(Anchored::Yes) {
             Some(s) => s,
             None => return Err(Error::DfaHasNoStartState),
         };
 
-        let mut transitions: HashMap<StateId, HashMap<TokenId, StateId>> = HashMap::default();
+        let stride2 = dfa.stride2();
+        let mut transitions: Vec<HashMap<TokenId, StateId>> = Vec::new();
+        fn state_transitions(
+            transitions: &mut Vec<HashMap<TokenId, StateId>>,
+            index: usize,
+        ) -> &mut HashMap<TokenId, StateId> {
+            if index >= transitions.len() {
+                transitions.resize_with(index + 1, HashMap::default);
+            }
+            &mut transitions[index]
+        }
         let mut final_states: HashSet<StateId> = HashSet::default();
 
+        // The tokens are walked from every reachable state, so they are gathered once into a
+        // contiguous list, leaving out the eos token, instead of iterating the vocabulary map.
+        let tokens: Vec<(&[u8], &[TokenId])> = vocabulary
+            .tokens()
+            .filter(|(_, ids)| !ids.contains(&eos_token_id))
+            .map(|(token, ids)| (token.as_slice(), ids))
+            .collect();
+
         let mut seen: HashSet<AutomataStateId> = HashSet::from_iter([start_state]);
         let mut next_states: Vec<AutomataStateId> = vec![start_state];
 
@@ -120,11 +203,7 @@ impl Index {
                 final_states.insert(current_state.as_u32());
             }
 
-            'token_loop: for (token, ids) in vocabulary.tokens().iter() {
-                if ids.contains(&eos_token_id) {
-                    continue;
-                }
-
+            'token_loop: for &(token, ids) in &tokens {
                 let mut next_state = current_state;
                 for transition_byte in token {
                     next_state = dfa.next_state(next_state, *transition_byte);
@@ -136,11 +215,10 @@ impl Index {
                 let is_intermediate_state = !dfa.is_match_state(next_state);
                 let is_full_match_state = dfa.is_match_state(dfa.next_eoi_state(next_state));
                 if is_intermediate_state || is_full_match_state {
+                    let current_transitions =
+                        state_transitions(&mut transitions, current_state.as_usize() >> stride2);
                     for token_id in ids {
-                        transitions
-                            .entry(current_state.as_u32())
-                            .or_default()
-                            .insert(*token_id, next_state.as_u32());
+                        current_transitions.insert(*token_id, next_state.as_u32());
                     }
                 }
                 if !seen.contains(&next_state) {
@@ -152,58 +230,194 @@ impl Index {
 
         // Populate `transitions` with mappings from `final_states` to `eos_token_id`
         for &final_state in &final_states {
-            transitions
-                .entry(final_state)
-                .or_default()
+            state_transitions(&mut transitions, final_state as usize >> stride2)
                 .insert(eos_token_id, final_state);
         }
 
+        let initial_tokens = transitions
+            .get(start_state.as_usize() >> stride2)
+            .map(|transitions| transitions.keys().copied().collect())
+            .unwrap_or_default();
+
+        let (masks, mask_rows, mask_words) = Self::build_masks(&transitions);
+
+        let mut final_states_bits = vec![0u64; transitions.len().div_ceil(64)];
+        for &final_state in &final_states {
+            let i = final_state as usize >> stride2;
+            final_states_bits[i / 64] |= 1 << (i % 64);
+        }
+
         Ok(Self {
             initial_state: start_state.as_u32(),
-            final_states,
+            initial_tokens,
+            final_states: final_states_bits,
             transitions,
+            stride2,
+            masks,
+            mask_rows,
+            mask_words,
             eos_token_id,
             vocab_size,
         })
     }
 
+    /// Builds the deduplicated bitmasks of allowed tokens of every state.
+    fn build_masks(transitions: &[HashMap<TokenId, StateId>]) -> (Vec<MaskBlock>, Vec<u32>, usize) {
+        let mask_words = transitions
+            .iter()
+            .flat_map(|transitions| transitions.keys())
+            .max()
+            .map_or(0, |&token| token as usize / 32 + 1);
+
+        let mut masks = Vec::new();
+        let mut rows: HashMap<Vec<u32>, u32> = HashMap::default();
+        let mask_rows = transitions
+            .iter()
+            .map(|transitions| {
+                let mut mask = vec![0u32; mask_words];
+                for &token in transitions.keys() {
+                    mask[token as usize / 32] |= 1 << (token % 32);
+                }
+                let next_row = rows.len() as u32;
+                *rows.entry(mask).or_insert_with_key(|mask| {
+                    masks.extend(mask.chunks(MaskBlock::WORDS).map(|words| {
+                        let mut block = MaskBlock([0; MaskBlock::WORDS]);
+                        block.0[..words.len()].copy_from_slice(words);
+                        block
+                    }));
+                    next_row
+                })
+            })
+            .collect();
+        (masks, mask_rows, mask_words)
+    }
+
     /// Returns the ID of the initial state in the automaton.
+    #[inline]
     pub fn initial_state(&self) -> StateId {
         self.initial_state
     }
 
+    /// Returns the tokens allowed in the initial state.
+    pub fn initial_tokens(&self) -> &[TokenId] {
+        &self.initial_tokens
+    }
+
     /// Returns set of final states.
-    pub fn final_states(&self) -> &HashSet<StateId> {
-        &self.final_states
+    pub fn final_states(&self) -> HashSet<StateId> {
+        self.final_states
+            .iter()
+            .enumerate()
+            .flat_map(|(word_index, &word)| {
+                (0..64)
+                    .filter(move |bit| (word >> bit) & 1 == 1)
+                    .map(move |bit| ((word_index * 64 + bit) << self.stride2) as StateId)
+            })
+            .collect()
     }
 
     /// Returns state transitions map of tokens ids and their corresponding transition states.
-    pub fn transitions(&self) -> &HashMap<StateId, HashMap<TokenId, StateId>> {
-        &self.transitions
+    pub fn transitions(&self) -> HashMap<StateId, HashMap<TokenId, StateId>> {
+        self.transitions
+            .iter()
+            .enumerate()
+            .filter(|(_, transitions)| !transitions.is_empty())
+            .map(|(i, transitions)| ((i << self.stride2) as StateId, transitions.clone()))
+            .collect()
+    }
+
+    /// Returns the map of tokens ids to transition states of a given state, or `None` if the
+    /// state has no transitions.
+    #[inline]
+    pub fn state_transitions(&self, state: &StateId) -> Option<&HashMap<TokenId, StateId>> {
+        let state = *state as usize;
+        if state & ((1 << self.stride2) - 1) != 0 {
+            return None;
+        }
+        self.transitions
+            .get(state >> self.stride2)
+            .filter(|transitions| !transitions.is_empty())
     }
 
     /// Checks if state is in final states set or not.
+    #[inline]
     pub fn is_final_state(&self, state: &StateId) -> bool {
-        self.final_states.contains(state)
+        let state = *state as usize;
+        if state & ((1 << self.stride2) - 1) != 0 {
+            return false;
+        }
+        let i = state >> self.stride2;
+        self.final_states
+            .get(i / 64)
+            .is_some_and(|word| (word >> (i % 64)) & 1 == 1)
     }
 
     /// Lists allowed tokens for a give state ID or `None` if it is not found in `Index`.
     pub fn allowed_tokens(&self, state: &StateId) -> Option<Vec<TokenId>> {
-        self.transitions
-            .get(state)
+        if *state == self.initial_state {
+            return (!self.initial_tokens.is_empty()).then(|| self.initial_tokens.clone());
+        }
+        self.state_transitions(state)
             .map(|res| res.keys().cloned().collect())
     }
 
     pub fn allowed_tokens_iter(&self, state: &StateId) -> Option<impl Iterator<Item = &TokenId>> {
-        self.transitions.get(state).map(|map| map.keys())
+        self.state_transitions(state).map(|map| map.keys())
+    }
+
+    /// Returns the only token allowed in a given state, or `None` if several (or no) tokens are
+    /// allowed there. A forced token doesn't need to be sampled, so callers can skip masking.
+    pub fn forced_token(&self, state: &StateId) -> Option<TokenId> {
+        let transitions = self.state_transitions(state)?;
+        if transitions.len() != 1 {
+            return None;
+        }
+        transitions.keys().next().copied()
+    }
+
+    /// Returns the bitmask of the tokens allowed in a given state, in which bit `token_id % 32`
+    /// of word `token_id / 32` is set for every allowed token, or `None` if the state has no
+    /// transitions. The bitmask ends with the word of the largest token ID allowed in any state.
+    #[inline]
+    pub fn state_mask(&self, state: &StateId) -> Option<&[u32]> {
+        self.state_transitions(state)?;
+        let row_blocks = self.mask_words.div_ceil(MaskBlock::WORDS);
+        let start = self.mask_rows[*state as usize >> self.stride2] as usize * row_blocks;
+        let blocks = &self.masks[start..start + row_blocks];
+        // Safety: `MaskBlock` is a `repr(C)` array of `u32` without padding, so the blocks are
+        // `row_blocks * MaskBlock::WORDS` contiguous words, of which `mask_words` are read.
+        Some(unsafe { std::slice::from_raw_parts(blocks.as_ptr().cast::<u32>(), self.mask_words) })
+    }
+
+    /// Writes the bitmask of the tokens allowed in a given state into `mask`: bit `token_id % 32`
+    /// of `mask[token_id / 32]` is set for every allowed token, all other bits are cleared.
+    /// Tokens which don't fit into `mask` are ignored.
+    pub fn write_mask_into(&self, state: &StateId, mask: &mut [u32]) {
+        let state_mask = self.state_mask(state).unwrap_or_default();
+        let len = state_mask.len().min(mask.len());
+        mask[..len].copy_from_slice(&state_mask[..len]);
+        mask[len..].fill(0);
     }
 
     /// Returns transition state for a given state and token id or `None` otherwise.
+    #[inline]
     pub fn next_state(&self, state: &StateId, token_id: &TokenId) -> Option<StateId> {
         if token_id == &self.eos_token_id {
             return None;
         }
-        Some(*self.transitions.get(state)?.get(token_id)?)
+        Some(*self.state_transitions(state)?.get(token_id)?)
+    }
+
+    /// Checks whether a sequence of tokens can be followed from a given state.
+    pub fn accepts_tokens(&self, state: &StateId, tokens: &[TokenId]) -> bool {
+        let mut state = *state;
+        for &token in tokens {
+            match self.next_state(&state, &token) {
+                Some(next_state) => state = next_state,
+                None => return false,
+            }
+        }
+        true
     }
 
     pub fn vocab_size(&self) -> usize {
@@ -211,10 +425,49 @@ impl Index {
     }
 }
 
+impl Encode for Index {
+    fn encode<E: Encoder>(&self, encoder: &mut E) -> Result<(), EncodeError> {
+        self.initial_state.encode(encoder)?;
+        self.initial_tokens.encode(encoder)?;
+        self.final_states.encode(encoder)?;
+        self.transitions.encode(encoder)?;
+        self.stride2.encode(encoder)?;
+        self.eos_token_id.encode(encoder)?;
+        self.vocab_size.encode(encoder)
+    }
+}
+
+impl<Context> Decode<Context> for Index {
+    fn decode<D: Decoder<Context = Context>>(decoder: &mut D) -> Result<Self, DecodeError> {
+        let initial_state = Decode::decode(decoder)?;
+        let initial_tokens = Decode::decode(decoder)?;
+        let final_states = Decode::decode(decoder)?;
+        let transitions: Vec<HashMap<TokenId, StateId>> = Decode::decode(decoder)?;
+        let stride2 = Decode::decode(decoder)?;
+        let eos_token_id = Decode::decode(decoder)?;
+        let vocab_size = Decode::decode(decoder)?;
+        let (masks, mask_rows, mask_words) = Self::build_masks(&transitions);
+        Ok(Self {
+            initial_state,
+            initial_tokens,
+            final_states,
+            transitions,
+            stride2,
+            masks,
+            mask_rows,
+            mask_words,
+            eos_token_id,
+            vocab_size,
+        })
+    }
+}
+
+bincode::impl_borrow_decode!(Index);
+
 impl std::fmt::Display for Index {
     fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
         writeln!(f, "Index object with transitions:")?;
-        for (state_id, token_ids) in self.transitions.iter() {
+        for (state_id, token_ids) in self.transitions().iter() {
             writeln!(f, "{:?} -> {:#?}", state_id, token_ids)?;
         }
         Ok(())
@@ -237,21 +490,30 @@ mod tests {
         }
         let index = Index::new(regex, &vocabulary).expect("Index failed");
         let initial_state = index.initial_state();
-        assert_eq!(initial_state, 40);
-        assert_eq!(index.final_states(), &HashSet::from_iter([24, 48, 56]));
+        assert_eq!(initial_state, 32);
+        assert_eq!(index.final_states(), HashSet::from_iter([24, 48, 40]));
         assert!(!index.is_final_state(&initial_state));
+        assert!(!index.is_final_state(&25));
+        assert!(!index.is_final_state(&(1 << 20)));
 
         let expected = HashMap::from_iter([
             (24, HashMap::from_iter([(3, 24), (4, 24), (2, 24)])),
             (48, HashMap::from_iter([(4, 48)])),
-            (40, HashMap::from_iter([(3, 48), (2, 56)])),
-            (56, HashMap::from_iter([(3, 24), (4, 56), (2, 24)])),
+            (32, HashMap::from_iter([(3, 48), (2, 40)])),
+            (40, HashMap::from_iter([(3, 24), (4, 40), (2, 24)])),
         ]);
-        assert_eq!(index.transitions(), &expected);
+        assert_eq!(index.transitions(), expected);
+        assert_eq!(index.state_transitions(&32), expected.get(&32));
+        assert_eq!(index.state_transitions(&33), None);
 
         let allowed_tokens = index
             .allowed_tokens(&initial_state)
             .expect("No allowed tokens");
+        assert_eq!(allowed_tokens, index.initial_tokens());
+        assert_eq!(
+            HashSet::from_iter(allowed_tokens.iter().copied()),
+            HashSet::from_iter([3, 2])
+        );
         let token_id = allowed_tokens.first().expect("No first tokens");
 
         let state = 48;
@@ -262,6 +524,151 @@ mod tests {
         assert_eq!(index.next_state(&state, token_id), None);
     }
 
+    #[test]
+    fn forced_token() {
+        let regex = "ab[0-9]";
+        let mut vocabulary = Vocabulary::new(4);
+        for (token, token_id) in [("a", 0), ("b", 1), ("1", 2), ("2", 3)] {
+            vocabulary
+                .try_insert(token, token_id as u32)
+                .expect("Insert failed");
+        }
+
+        let index = Index::new(regex, &vocabulary).expect("Index failed");
+        let initial_state = index.initial_state();
+        assert_eq!(index.forced_token(&initial_state), Some(0));
+
+        let state = index.next_state(&initial_state, &0).expect("No next state");
+        assert_eq!(index.forced_token(&state), Some(1));
+
+        let state = index.next_state(&state, &1).expect("No next state");
+        assert_eq!(index.forced_token(&state), None);
+
+        let state = index.next_state(&state, &2).expect("No next state");
+        assert_eq!(index.forced_token(&state), Some(4));
+    }
+
+    #[test]
+    fn write_mask_into() {
+        let regex = "0|[1-9][0-9]*";
+        let eos_token_id = 40;
+        let mut vocabulary = Vocabulary::new(eos_token_id);
+        for (token, token_id) in [("blah", 0), ("1a", 1), ("2", 2), ("0", 33)] {
+            vocabulary
+                .try_insert(token, token_id as u32)
+                .expect("Insert failed");
+        }
+        let index = Index::new(regex, &vocabulary).expect("Index failed");
+        let initial_state = index.initial_state();
+
+        assert_eq!(
+            index.state_mask(&initial_state),
+            Some(&[1 << 2, 1 << 1][..])
+        );
+        assert_eq!(index.state_mask(&(initial_state + 1)), None);
+
+        let mut mask = [u32::MAX; 2];
+        index.write_mask_into(&initial_state, &mut mask);
+        assert_eq!(mask, [1 << 2, 1 << 1]);
+
+        // The mask is padded with zeros past the largest token ID
+        let mut mask = [u32::MAX; 3];
+        index.write_mask_into(&initial_state, &mut mask);
+        assert_eq!(mask, [1 << 2, 1 << 1, 0]);
+
+        // Tokens past the end of the mask are dropped
+        let mut mask = [u32::MAX; 1];
+        index.write_mask_into(&initial_state, &mut mask);
+        assert_eq!(mask, [1 << 2]);
+
+        // Final state: only the eos token is allowed
+        let state = index
+            .next_state(&initial_state, &33)
+            .expect("No next state");
+        let mut mask = [0; 2];
+        index.write_mask_into(&state, &mut mask);
+        assert_eq!(mask, [0, 1 << 8]);
+    }
+
+    #[test]
+    fn compiled_dfa_is_shared() {
+        let regex = "[a-z]+@[a-z]+";
+        let dfa = compiled_dfa(regex).expect("DFA failed");
+        assert!(Arc::ptr_eq(&dfa, &compiled_dfa(regex).expect("DFA failed")));
+        assert!(compiled_dfa("[").is_err());
+    }
+
+    #[test]
+    fn state_masks_are_aligned() {
+        let regex = "[ab]+";
+        let mut vocabulary = Vocabulary::new(700);
+        for (token, token_id) in [("a", 3), ("b", 600), ("c", 5)] {
+            vocabulary
+                .try_insert(token, token_id as u32)
+                .expect("Insert failed");
+        }
+        let index = Index::new(regex, &vocabulary).expect("Index failed");
+
+        let initial_state = index.initial_state();
+        let next_state = index.next_state(&initial_state, &3).expect("No next state");
+        for state in [initial_state, next_state] {
+            let mask = index.state_mask(&state).expect("No mask");
+            assert_eq!(mask.len(), 700 / 32 + 1);
+            assert_eq!(mask.as_ptr() as usize % 64, 0);
+            let allowed: Vec<usize> = (0..mask.len() * 32)
+                .filter(|&token| (mask[token / 32] >> (token % 32)) & 1 == 1)
+                .collect();
+            let expected = if state == initial_state {
+                vec![3, 600]
+            } else {
+                vec![3, 600, 700]
+            };
+            assert_eq!(allowed, expected);
+        }
+    }
+
+    #[test]
+    fn encoding_rebuilds_masks() {
+        let mut vocabulary = Vocabulary::new(700);
+        for (token, token_id) in [("a", 3), ("b", 600), ("c", 5)] {
+            vocabulary
+                .try_insert(token, token_id as u32)
+                .expect("Insert failed");
+        }
+        let index = Index::new("[ab]+c", &vocabulary).expect("Index failed");
+
+        let config = bincode::config::standard();
+        let encoded = bincode::encode_to_vec(&index, config).expect("Encoding failed");
+        // A single mask row takes 2 cache lines.
+        assert!(encoded.len() < 2 * 64);
+        let (decoded, _): (Index, usize) =
+            bincode::decode_from_slice(&encoded, config).expect("Decoding failed");
+        assert_eq!(decoded, index);
+    }
+
+    #[test]
+    fn accepts_tokens() {
+        let regex = "0|[1-9][0-9]*";
+        let eos_token_id = 4;
+        let mut vocabulary = Vocabulary::new(eos_token_id);
+        for (token, token_id) in [("blah", 0), ("1a", 1), ("2", 2), ("0", 3)] {
+            vocabulary
+                .try_insert(token, token_id as u32)
+                .expect("Insert failed");
+        }
+        let index = Index::new(regex, &vocabulary).expect("Index failed");
+        let initial_state = index.initial_state();
+
+        assert!(index.accepts_tokens(&initial_state, &[]));
+        assert!(index.accepts_tokens(&initial_state, &[2, 3, 2]));
+        assert!(index.accepts_tokens(&initial_state, &[3]));
+        assert!(!index.accepts_tokens(&initial_state, &[3, 2]));
+        assert!(!index.accepts_tokens(&initial_state, &[1]));
+        assert!(!index.accepts_tokens(&initial_state, &[2, 1000]));
+        // The eos token ends the sequence without a transition
+        assert!(!index.accepts_tokens(&initial_state, &[2, eos_token_id]));
+    }
+
     #[test]
     fn index_from_regex_initital_in_allowed() {
         let regex = "`\\n(\\.\\n)?`\\n";
@@ -300,19 +707,19 @@ mod tests {
         }
 
         let index = Index::new(regex, &vocabulary).expect("Index failed");
-        assert_eq!(index.final_states(), &HashSet::from_iter([208, 128]));
+        assert_eq!(index.final_states(), HashSet::from_iter([192, 112]));
 
         let expected = HashMap::from_iter([
             (
-                208,
-                HashMap::from_iter([(3, 208), (8, 208), (4, 208), (2, 208)]),
+                192,
+                HashMap::from_iter([(3, 192), (8, 192), (4, 192), (2, 192)]),
             ),
             (
-                80,
-                HashMap::from_iter([(2, 128), (7, 192), (5, 208), (6, 208)]),
+                64,
+                HashMap::from_iter([(2, 112), (7, 176), (5, 192), (6, 192)]),
             ),
-            (128, HashMap::from_iter([(8, 128)])),
+            (112, HashMap::from_iter([(8, 112)])),
         ]);
-        assert_eq!(index.transitions(), &expected);
+        assert_eq!(index.transitions(), expected);
     }
 }
@@ -0,0 +1,358 @@
+//! Kernels applying token bitmasks to logits, and sampling from them.
+//!
+//! A token bitmask holds one bit per token: bit `token_id % 32` of word `token_id / 32` is set
+//! when the token is allowed. Applying it sets the logits of the disallowed tokens to negative
+//! infinity and leaves the others untouched. Logits of tokens past the end of the mask are
+//! disallowed.
+//!
+//! Logits narrower than 32 bits (e.g. float16, bfloat16 or int8) are masked on their bit
+//! patterns, with the caller providing the value written into disallowed logits.
+
+use crate::primitives::TokenId;
+
+/// Applies `mask` to `logits`, see the [module documentation](self).
+///
+/// The implementation is selected at runtime. On x86-64, AVX-512 CPUs store negative infinity
+/// with the mask words as write masks, AVX2 CPUs run the portable implementation compiled for
+/// 256-bit vectors. On aarch64, NEON selects 4 logits at a time with a bitwise select.
+pub fn apply_token_bitmask_f32(logits: &mut [f32], mask: &[u32]) {
+    #[cfg(target_arch = "x86_64")]
+    {
+        if is_x86_feature_detected!("avx512f") {
+            // Safety: the CPU supports AVX-512F.
+            return unsafe { x86::apply_token_bitmask_f32_avx512(logits, mask) };
+        }
+        if is_x86_feature_detected!("avx2") {
+            // Safety: the CPU supports AVX2.
+            return unsafe { x86::apply_token_bitmask_f32_avx2(logits, mask) };
+        }
+    }
+    #[cfg(target_arch = "aarch64")]
+    {
+        if std::arch::is_aarch64_feature_detected!("neon") {
+            // Safety: the CPU supports NEON.
+            return unsafe { aarch64::apply_token_bitmask_f32_neon(logits, mask) };
+        }
+    }
+    apply_token_bitmask(logits, mask, f32::NEG_INFINITY)
+}
+
+/// Applies `mask` to `logits`, see the [module documentation](self).
+///
+/// Implementations are selected at runtime like in [`apply_token_bitmask_f32`], the AVX-512 one
+/// storing 8 logits per mask byte and the NEON one selecting 2 logits at a time.
+pub fn apply_token_bitmask_f64(logits: &mut [f64], mask: &[u32]) {
+    #[cfg(target_arch = "x86_64")]
+    {
+        if is_x86_feature_detected!("avx512f") {
+            // Safety: the CPU supports AVX-512F.
+            return unsafe { x86::apply_token_bitmask_f64_avx512(logits, mask) };
+        }
+        if is_x86_feature_detected!("avx2") {
+            // Safety: the CPU supports AVX2.
+            return unsafe { x86::apply_token_bitmask_f64_avx2(logits, mask) };
+        }
+    }
+    #[cfg(target_arch = "aarch64")]
+    {
+        if std::arch::is_aarch64_feature_detected!("neon") {
+            // Safety: the CPU supports NEON.
+            return unsafe { aarch64::apply_token_bitmask_f64_neon(logits, mask) };
+        }
+    }
+    apply_token_bitmask(logits, mask, f64::NEG_INFINITY)
+}
+
+/// Applies `mask` to 16-bit `logits`, writing `fill` (e.g. the bit pattern of the float16 or
+/// bfloat16 negative infinity) into the disallowed ones.
+///
+/// On x86-64, AVX-512BW CPUs store `fill` with each mask word as the write mask of 32 logits,
+/// other CPUs run the portable implementation.
+pub fn apply_token_bitmask_u16(logits: &mut [u16], mask: &[u32], fill: u16) {
+    #[cfg(target_arch = "x86_64")]
+    {
+        if is_x86_feature_detected!("avx512bw") {
+            // Safety: the CPU supports AVX-512BW.
+            return unsafe { x86::apply_token_bitmask_u16_avx512(logits, mask, fill) };
+        }
+    }
+    apply_token_bitmask(logits, mask, fill)
+}
+
+/// Applies `mask` to 8-bit `logits`, writing `fill` (e.g. the bit pattern of -128 for int8
+/// logits) into the disallowed ones.
+///
+/// Implementations are selected at runtime like in [`apply_token_bitmask_u16`], the AVX-512 one
+/// storing 64 logits per pair of mask words.
+pub fn apply_token_bitmask_u8(logits: &mut [u8], mask: &[u32], fill: u8) {
+    #[cfg(target_arch = "x86_64")]
+    {
+        if is_x86_feature_detected!("avx512bw") {
+            // Safety: the CPU supports AVX-512BW.
+            return unsafe { x86::apply_token_bitmask_u8_avx512(logits, mask, fill) };
+        }
+    }
+    apply_token_bitmask(logits, mask, fill)
+}
+
+/// Samples a token allowed by `mask`, with a probability proportional to its weight in `probs`,
+/// by inverse transform sampling of the uniform number `u` in `[0, 1)`. Allowed tokens are taken
+/// in increasing order, so that the result matches sampling from the masked and normalized
+/// weights, e.g. with `numpy.random.Generator.choice`. Weights must be non-negative, tokens past
+/// the end of `probs` are never sampled.
+///
+/// Returns `None` if no allowed token has a positive weight.
+pub fn sample_token<F: Copy + Into<f64>>(mask: &[u32], probs: &[F], u: f64) -> Option<TokenId> {
+    let allowed = || {
+        mask.iter()
+            .enumerate()
+            .flat_map(|(i, &word)| {
+                // Walks the set bits of the word, lowest first.
+                let mut bits = word;
+                std::iter::from_fn(move || {
+                    (bits != 0).then(|| {
+                        let bit = bits.trailing_zeros() as usize;
+                        bits &= bits - 1;
+                        i * 32 + bit
+                    })
+                })
+            })
+            .map_while(|token| probs.get(token).map(|&p| (token, p.into())))
+    };
+    let total: f64 = allowed().map(|(_, p)| p).sum();
+    if total <= 0.0 {
+        return None;
+    }
+
+    let target = u * total;
+    let mut cumulative = 0.0;
+    let mut last = None;
+    for (token, p) in allowed() {
+        if p <= 0.0 {
+            continue;
+        }
+        cumulative += p;
+        last = Some(token as TokenId);
+        if cumulative > target {
+            break;
+        }
+    }
+    // Rounding may leave the cumulative sum short of the target for `u` close to 1, in which
+    // case the last token with a positive weight is sampled.
+    last
+}
+
+/// Portable implementation of the kernels. The logits are walked along the mask one 32-token
+/// word at a time, skipping words in which every token is allowed.
+#[inline(always)]
+fn apply_token_bitmask<F: Copy>(logits: &mut [F], mask: &[u32], fill: F) {
+    for (i, chunk) in logits.chunks_mut(32).enumerate() {
+        let word = mask.get(i).copied().unwrap_or(0);
+        if word == u32::MAX {
+            continue;
+        }
+        // Branchless select, so the loop is vectorized.
+        for (bit, logit) in chunk.iter_mut().enumerate() {
+            *logit = if (word >> bit) & 1 == 0 { fill } else { *logit };
+        }
+    }
+}
+
+#[cfg(target_arch = "x86_64")]
+mod x86 {
+    use std::arch::x86_64::*;
+
+    #[target_feature(enable = "avx2")]
+    pub(super) unsafe fn apply_token_bitmask_f32_avx2(logits: &mut [f32], mask: &[u32]) {
+        super::apply_token_bitmask(logits, mask, f32::NEG_INFINITY)
+    }
+
+    #[target_feature(enable = "avx512f")]
+    pub(super) unsafe fn apply_token_bitmask_f32_avx512(logits: &mut [f32], mask: &[u32]) {
+        let neg_inf = _mm512_set1_ps(f32::NEG_INFINITY);
+        let full_words = (logits.len() / 32).min(mask.len());
+        let (head, tail) = logits.split_at_mut(full_words * 32);
+        for (chunk, &word) in head.chunks_exact_mut(32).zip(mask) {
+            if word == u32::MAX {
+                continue;
+            }
+            // Each half of the inverted word is the write mask of 16 logits.
+            let ptr = chunk.as_mut_ptr();
+            _mm512_mask_storeu_ps(ptr, !word as __mmask16, neg_inf);
+            _mm512_mask_storeu_ps(ptr.add(16), !(word >> 16) as __mmask16, neg_inf);
+        }
+        super::apply_token_bitmask(tail, &mask[full_words..], f32::NEG_INFINITY);
+    }
+
+    #[target_feature(enable = "avx2")]
+    pub(super) unsafe fn apply_token_bitmask_f64_avx2(logits: &mut [f64], mask: &[u32]) {
+        super::apply_token_bitmask(logits, mask, f64::NEG_INFINITY)
+    }
+
+    #[target_feature(enable = "avx512f")]
+    pub(super) unsafe fn apply_token_bitmask_f64_avx512(logits: &mut [f64], mask: &[u32]) {
+        let neg_inf = _mm512_set1_pd(f64::NEG_INFINITY);
+        let full_words = (logits.len() / 32).min(mask.len());
+        let (head, tail) = logits.split_at_mut(full_words * 32);
+        for (chunk, &word) in head.chunks_exact_mut(32).zip(mask) {
+            if word == u32::MAX {
+                continue;
+            }
+            // Each byte of the inverted word is the write mask of 8 logits.
+            let ptr = chunk.as_mut_ptr();
+            for (i, byte) in (!word).to_le_bytes().into_iter().enumerate() {
+                _mm512_mask_storeu_pd(ptr.add(8 * i), byte, neg_inf);
+            }
+        }
+        super::apply_token_bitmask(tail, &mask[full_words..], f64::NEG_INFINITY);
+    }
+
+    #[target_feature(enable = "avx512bw")]
+    pub(super) unsafe fn apply_token_bitmask_u16_avx512(
+        logits: &mut [u16],
+        mask: &[u32],
+        fill: u16,
+    ) {
+        let fill_vector = _mm512_set1_epi16(fill as i16);
+        let full_words = (logits.len() / 32).min(mask.len());
+        let (head, tail) = logits.split_at_mut(full_words * 32);
+        for (chunk, &word) in head.chunks_exact_mut(32).zip(mask) {
+            if word == u32::MAX {
+                continue;
+            }
+            // The inverted word is the write mask of the 32 logits.
+            _mm512_mask_storeu_epi16(chunk.as_mut_ptr().cast(), !word, fill_vector);
+        }
+        super::apply_token_bitmask(tail, &mask[full_words..], fill);
+    }
+
+    #[target_feature(enable = "avx512bw")]
+    pub(super) unsafe fn apply_token_bitmask_u8_avx512(logits: &mut [u8], mask: &[u32], fill: u8) {
+        let fill_vector = _mm512_set1_epi8(fill as i8);
+        let full_pairs = (logits.len() / 64).min(mask.len() / 2);
+        let (head, tail) = logits.split_at_mut(full_pairs * 64);
+        for (chunk, words) in head.chunks_exact_mut(64).zip(mask.chunks_exact(2)) {
+            if words[0] & words[1] == u32::MAX {
+                continue;
+            }
+            // Two inverted words are the write mask of 64 logits.
+            let allowed = u64::from(words[0]) | (u64::from(words[1]) << 32);
+            _mm512_mask_storeu_epi8(chunk.as_mut_ptr().cast(), !allowed, fill_vector);
+        }
+        super::apply_token_bitmask(tail, &mask[2 * full_pairs..], fill);
+    }
+}
+
+#[cfg(target_arch = "aarch64")]
+mod aarch64 {
+    use std::arch::aarch64::*;
+
+    #[target_feature(enable = "neon")]
+    pub(super) unsafe fn apply_token_bitmask_f32_neon(logits: &mut [f32], mask: &[u32]) {
+        let neg_inf = vdupq_n_f32(f32::NEG_INFINITY);
+        let lane_bits = vld1q_u32([1u32, 2, 4, 8].as_ptr());
+        let full_words = (logits.len() / 32).min(mask.len());
+        let (head, tail) = logits.split_at_mut(full_words * 32);
+        for (chunk, &word) in head.chunks_exact_mut(32).zip(mask) {
+            if word == u32::MAX {
+                continue;
+            }
+            // Lanes whose bit is set in the broadcast nibble keep their logit.
+            for (i, lanes) in chunk.chunks_exact_mut(4).enumerate() {
+                let allowed = vtstq_u32(vdupq_n_u32(word >> (4 * i)), lane_bits);
+                let ptr = lanes.as_mut_ptr();
+                vst1q_f32(ptr, vbslq_f32(allowed, vld1q_f32(ptr), neg_inf));
+            }
+        }
+        super::apply_token_bitmask(tail, &mask[full_words..], f32::NEG_INFINITY);
+    }
+
+    #[target_feature(enable = "neon")]
+    pub(super) unsafe fn apply_token_bitmask_f64_neon(logits: &mut [f64], mask: &[u32]) {
+        let neg_inf = vdupq_n_f64(f64::NEG_INFINITY);
+        let lane_bits = vld1q_u64([1u64, 2].as_ptr());
+        let full_words = (logits.len() / 32).min(mask.len());
+        let (head, tail) = logits.split_at_mut(full_words * 32);
+        for (chunk, &word) in head.chunks_exact_mut(32).zip(mask) {
+            if word == u32::MAX {
+                continue;
+            }
+            for (i, lanes) in chunk.chunks_exact_mut(2).enumerate() {
+                let allowed = vtstq_u64(vdupq_n_u64(u64::from(word >> (2 * i))), lane_bits);
+                let ptr = lanes.as_mut_ptr();
+                vst1q_f64(ptr, vbslq_f64(allowed, vld1q_f64(ptr), neg_inf));
+            }
+        }
+        super::apply_token_bitmask(tail, &mask[full_words..], f64::NEG_INFINITY);
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn masked<F: Copy>(logits: &[F], mask: &[u32], neg_inf: F) -> Vec<F> {
+        logits
+            .iter()
+            .enumerate()
+            .map(|(token, &logit)| {
+                let allowed = mask
+                    .get(token / 32)
+                    .is_some_and(|word| (word >> (token % 32)) & 1 == 1);
+                if allowed {
+                    logit
+                } else {
+                    neg_inf
+                }
+            })
+            .collect()
+    }
+
+    #[test]
+    fn sample_token_inverts_the_cdf() {
+        let mask = [0b1011, 0b1];
+        let probs = [0.25f32, 0.5, 9.0, 0.25];
+
+        assert_eq!(sample_token(&mask, &probs, 0.0), Some(0));
+        assert_eq!(sample_token(&mask, &probs, 0.24), Some(0));
+        assert_eq!(sample_token(&mask, &probs, 0.25), Some(1));
+        assert_eq!(sample_token(&mask, &probs, 0.74), Some(1));
+        assert_eq!(sample_token(&mask, &probs, 0.75), Some(3));
+        assert_eq!(sample_token(&mask, &probs, 0.999_999), Some(3));
+
+        // Token 32 is allowed, but past the end of the weights.
+        assert_eq!(sample_token(&[0, 1], &probs, 0.5), None);
+        assert_eq!(sample_token(&mask, &[0.0f64; 4], 0.5), None);
+    }
+
+    #[test]
+    fn apply_token_bitmask_matches_bits() {
+        let mask = [u32::MAX, 0, 0x8000_0001, 0x1234_5678, 0b101];
+        // Logits covering the mask exactly, ending in a partial word and extending past it.
+        for len in [160, 140, 200, 7] {
+            let mut logits: Vec<f32> = (0..len).map(|i| i as f32).collect();
+            let expected = masked(&logits, &mask, f32::NEG_INFINITY);
+
+            apply_token_bitmask_f32(&mut logits, &mask);
+            assert_eq!(logits, expected);
+
+            let mut logits: Vec<f64> = (0..len).map(|i| i as f64).collect();
+            let expected = masked(&logits, &mask, f64::NEG_INFINITY);
+
+            apply_token_bitmask_f64(&mut logits, &mask);
+            assert_eq!(logits, expected);
+
+            let mut logits: Vec<u16> = (0..len).map(|i| i as u16).collect();
+            let expected = masked(&logits, &mask, 0xFC00);
+
+            apply_token_bitmask_u16(&mut logits, &mask, 0xFC00);
+            assert_eq!(logits, expected);
+
+            let mut logits: Vec<u8> = (0..len).map(|i| i as u8).collect();
+            let expected = masked(&logits, &mask, 0x80);
+
+            apply_token_bitmask_u8(&mut logits, &mask, 0x80);
+            assert_eq!(logits, expected);
+        }
+    }
+}
@@ -83,11 +83,14 @@
 pub mod error;
 pub mod index;
 pub mod json_schema;
+pub mod kernels;
 pub mod prelude;
 pub mod primitives;
 pub mod vocabulary;
 
 pub use error::{Error, Result};
 
+mod fifo_cache;
+
 #[cfg(feature = "python-bindings")]
 mod python_bindings;
@@ -1,19 +1,22 @@
 //! Provides tools and interfaces to integrate the crate's functionality with Python.
 
 use std::collections::VecDeque;
-use std::sync::Arc;
+use std::sync::{Arc, Mutex};
 
 use bincode::{config, Decode, Encode};
+use once_cell::sync::{Lazy, OnceCell};
 use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
-use pyo3::types::{PyAny, PyDict};
+use pyo3::types::{PyAny, PyBytes, PyDict, PyList, PyString};
 use pyo3::wrap_pyfunction;
 use rustc_hash::{FxHashMap as HashMap, FxHashSet as HashSet};
 #[cfg(feature = "hugginface-hub")]
 use tokenizers::FromPretrainedParameters;
 
+use crate::fifo_cache::FifoCache;
 use crate::index::Index;
 use crate::json_schema;
+use crate::kernels;
 use crate::prelude::*;
 
 macro_rules! type_name {
@@ -23,13 +26,298 @@ macro_rules! type_name {
     };
 }
 
+/// Checks that `data_ptr`, `numel` and `element_size` describe a buffer of 32-bit integers
+/// which can hold a mask of `expected_elements` elements.
+fn check_mask_buffer(
+    data_ptr: usize,
+    numel: usize,
+    element_size: usize,
+    expected_elements: usize,
+) -> PyResult<()> {
+    if element_size != 4 {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "Invalid element size: got {} bytes per element, expected 4 bytes (32-bit integer).",
+            element_size
+        )));
+    } else if data_ptr == 0 {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            "Invalid data pointer: received a null pointer.",
+        ));
+    } else if data_ptr % 4 != 0 {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
+            "Invalid data pointer alignment: pointer address {} is not a multiple of 4.",
+            data_ptr
+        )));
+    } else if numel < expected_elements {
+        return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
+            format!(
+                "Invalid buffer size: got {} elements ({} bytes), expected {} elements ({} bytes). \
+                Ensure that the mask tensor has shape (1, (vocab_size + 31) // 32) and uses 32-bit integers.",
+                numel,
+                numel * element_size,
+                expected_elements,
+                expected_elements * 4
+            )
+        ));
+    }
+    Ok(())
+}
+
+/// Checks that `data_ptr` and `element_size` describe a buffer of float32 or float64.
+fn check_float_buffer(data_ptr: usize, element_size: usize) -> PyResult<()> {
+    if element_size != 4 && element_size != 8 {
+        return Err(PyValueError::new_err(format!(
+            "Invalid element size: got {} bytes per element, expected 4 bytes (float32) or 8 bytes (float64).",
+            element_size
+        )));
+    } else if data_ptr == 0 {
+        return Err(PyValueError::new_err(
+            "Invalid data pointer: received a null pointer.",
+        ));
+    } else if data_ptr % element_size != 0 {
+        return Err(PyValueError::new_err(format!(
+            "Invalid data pointer alignment: pointer address {} is not a multiple of {}.",
+            data_ptr, element_size
+        )));
+    }
+    Ok(())
+}
+
+/// Writes the masks of allowed tokens of `rows` of index and state into the memory specified
+/// by `data_ptr`, one row each, with a single release of the GIL. The memory must be a
+/// contiguous (rows.len(), numel / rows.len()) array of 32-bit integers.
+fn write_mask_rows(
+    py: Python<'_>,
+    rows: &[(Arc<Index>, StateId)],
+    data_ptr: usize,
+    numel: usize,
+    element_size: usize,
+) -> PyResult<()> {
+    if rows.is_empty() {
+        return Err(PyValueError::new_err(
+            "Invalid batch size: received an empty list of guides.",
+        ));
+    } else if numel % rows.len() != 0 {
+        return Err(PyValueError::new_err(format!(
+            "Invalid buffer size: got {} elements, which can't be split into {} rows of equal size.",
+            numel,
+            rows.len()
+        )));
+    }
+    let row_len = numel / rows.len();
+    let expected_elements = rows
+        .iter()
+        .map(|(index, _)| index.vocab_size().div_ceil(32))
+        .max()
+        .unwrap_or_default();
+    check_mask_buffer(data_ptr, row_len, element_size, expected_elements)?;
+
+    py.allow_threads(|| {
+        let mask = unsafe { std::slice::from_raw_parts_mut(data_ptr as *mut u32, numel) };
+        for ((index, state), row) in rows.iter().zip(mask.chunks_exact_mut(row_len)) {
+            index.write_mask_into(state, row);
+        }
+    });
+    Ok(())
+}
+
+/// Sets the logits of the tokens not allowed in `state` to `neg_inf`, without materializing
+/// a mask tensor.
+///
+/// When few tokens are allowed (at most a quarter of the logits), the row is filled with
+/// `neg_inf` up to each mask word with allowed tokens, whose logits are restored, which is
+/// cheaper than testing every bit. Otherwise the bitmask of the state is applied with
+/// `apply`, one of the SIMD kernels of [`kernels`].
+fn mask_logits<F: Copy>(
+    index: &Index,
+    state: StateId,
+    logits: &mut [F],
+    neg_inf: F,
+    apply: fn(&mut [F], &[u32]),
+) {
+    let allowed_count = index
+        .state_transitions(&state)
+        .map_or(0, |transitions| transitions.len());
+
+    let allowed = index.state_mask(&state).unwrap_or_default();
+    if allowed_count <= logits.len() / 4 {
+        // The logits up to each word with allowed tokens are filled at once, and its allowed
+        // logits are saved aside on the stack and restored, so nothing is allocated.
+        let mut filled = 0;
+        for (i, &word) in allowed.iter().enumerate().filter(|(_, &word)| word != 0) {
+            let start = i * 32;
+            if start >= logits.len() {
+                break;
+            }
+            let end = (start + 32).min(logits.len());
+            let word = word & (u32::MAX >> (32 - (end - start)));
+            let mut saved = [neg_inf; 32];
+            let mut bits = word;
+            while bits != 0 {
+                let bit = bits.trailing_zeros() as usize;
+                saved[bit] = logits[start + bit];
+                bits &= bits - 1;
+            }
+            logits[filled..end].fill(neg_inf);
+            let mut bits = word;
+            while bits != 0 {
+                let bit = bits.trailing_zeros() as usize;
+                logits[start + bit] = saved[bit];
+                bits &= bits - 1;
+            }
+            filled = end;
+        }
+        logits[filled..].fill(neg_inf);
+        return;
+    }
+
+    apply(logits, allowed);
+}
+
+/// Applies token bitmasks to logits inplace, setting the logits of disallowed tokens to -inf.
+///
+/// `logits_ptr` should be the data ptr to a contiguous (batch, logits_numel / batch) array of
+/// logits of `element_size` bytes, and `mask_ptr` to a contiguous (batch, mask_numel / batch)
+/// array of 32-bit integers, as returned by `allocate_token_bitmask`. Logits past the end of a
+/// mask row are disallowed.
+///
+/// 4 and 8 bytes logits are float32 and float64. 1 and 2 bytes logits (e.g. int8, float16 or
+/// bfloat16) are masked on their bit patterns and `fill` is required: it is the bit pattern
+/// written into the disallowed logits, e.g. `0xFC00` for float16 -inf or `0x80` for int8 -128.
+#[pyfunction]
+#[pyo3(signature = (logits_ptr, logits_numel, element_size, mask_ptr, mask_numel, batch, fill=None))]
+#[allow(clippy::too_many_arguments)]
+pub fn apply_token_bitmask_inplace(
+    py: Python<'_>,
+    logits_ptr: usize,
+    logits_numel: usize,
+    element_size: usize,
+    mask_ptr: usize,
+    mask_numel: usize,
+    batch: usize,
+    fill: Option<u16>,
+) -> PyResult<()> {
+    match (element_size, fill) {
+        (4 | 8, None) | (2, Some(_)) => {}
+        (1, Some(fill)) if fill <= u16::from(u8::MAX) => {}
+        (1, Some(fill)) => {
+            return Err(PyValueError::new_err(format!(
+                "Invalid fill: got {:#x}, which doesn't fit in a 1 byte element.",
+                fill
+            )));
+        }
+        (1 | 2, None) => {
+            return Err(PyValueError::new_err(format!(
+                "Invalid fill: a fill bit pattern is required for {} byte elements.",
+                element_size
+            )));
+        }
+        (4 | 8, Some(_)) => {
+            return Err(PyValueError::new_err(format!(
+                "Invalid fill: {} byte elements are floats filled with -inf, got a fill bit pattern.",
+                element_size
+            )));
+        }
+        _ => {
+            return Err(PyValueError::new_err(format!(
+                "Invalid element size: got {} bytes per element, expected 1, 2, 4 or 8 bytes.",
+                element_size
+            )));
+        }
+    }
+    if batch == 0 || logits_numel % batch != 0 || mask_numel % batch != 0 {
+        return Err(PyValueError::new_err(format!(
+            "Invalid batch size: got {} logits and {} mask elements, which can't be split into {} rows of equal size.",
+            logits_numel, mask_numel, batch
+        )));
+    }
+    for (name, ptr, align) in [("logits", logits_ptr, element_size), ("mask", mask_ptr, 4)] {
+        if ptr == 0 {
+            return Err(PyValueError::new_err(format!(
+                "Invalid {} pointer: received a null pointer.",
+                name
+            )));
+        } else if ptr % align != 0 {
+            return Err(PyValueError::new_err(format!(
+                "Invalid {} pointer alignment: pointer address {} is not a multiple of {}.",
+                name, ptr, align
+            )));
+        }
+    }
+    let fill = fill.unwrap_or_default();
+    py.allow_threads(|| {
+        let mask = unsafe { std::slice::from_raw_parts(mask_ptr as *const u32, mask_numel) };
+        match element_size {
+            1 => {
+                let logits =
+                    unsafe { std::slice::from_raw_parts_mut(logits_ptr as *mut u8, logits_numel) };
+                apply_rows(logits, mask, batch, |logits, mask| {
+                    kernels::apply_token_bitmask_u8(logits, mask, fill as u8)
+                });
+            }
+            2 => {
+                let logits =
+                    unsafe { std::slice::from_raw_parts_mut(logits_ptr as *mut u16, logits_numel) };
+                apply_rows(logits, mask, batch, |logits, mask| {
+                    kernels::apply_token_bitmask_u16(logits, mask, fill)
+                });
+            }
+            4 => {
+                let logits =
+                    unsafe { std::slice::from_raw_parts_mut(logits_ptr as *mut f32, logits_numel) };
+                apply_rows(logits, mask, batch, kernels::apply_token_bitmask_f32);
+            }
+            _ => {
+                let logits =
+                    unsafe { std::slice::from_raw_parts_mut(logits_ptr as *mut f64, logits_numel) };
+                apply_rows(logits, mask, batch, kernels::apply_token_bitmask_f64);
+            }
+        }
+    });
+    Ok(())
+}
+
+/// Calls `apply` on each of the `batch` rows of `logits` and of `mask`.
+fn apply_rows<F>(logits: &mut [F], mask: &[u32], batch: usize, apply: impl Fn(&mut [F], &[u32])) {
+    let (logits_len, mask_len) = (logits.len() / batch, mask.len() / batch);
+    for row in 0..batch {
+        apply(
+            &mut logits[row * logits_len..(row + 1) * logits_len],
+            &mask[row * mask_len..(row + 1) * mask_len],
+        );
+    }
+}
+
+/// Calls `f` with the bytes of a `str` or `bytes` token. They are borrowed from the Python
+/// object, rather than copied, for these two types.
+fn with_token_bytes<R>(token: &Bound<'_, PyAny>, f: impl FnOnce(&[u8]) -> R) -> PyResult<R> {
+    if let Ok(Ok(token)) = token.downcast::<PyString>().map(|t| t.to_str()) {
+        return Ok(f(token.as_bytes()));
+    }
+    if let Ok(token) = token.downcast::<PyBytes>() {
+        return Ok(f(token.as_bytes()));
+    }
+    if let Ok(token) = token.extract::<Token>() {
+        return Ok(f(&token));
+    }
+    Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(format!(
+        "Expected a token of type str or bytes, got {:?}",
+        type_name!(token)
+    )))
+}
+
 /// Guide object based on Index.
 #[pyclass(name = "Guide", module = "outlines_core")]
 #[derive(Clone, Debug, PartialEq, Encode, Decode)]
 pub struct PyGuide {
     state: StateId,
     index: PyIndex,
+    /// Ring buffer of the last `max_rollback` states, the most recent at the back.
     state_cache: VecDeque<StateId>,
+    /// The number of states kept for rollback. It is stored rather than taken from the
+    /// capacity of `state_cache`, which may be larger than requested and isn't preserved by
+    /// pickling.
+    max_rollback: usize,
 }
 
 #[pymethods]
@@ -42,6 +330,7 @@ impl PyGuide {
             state: index.get_initial_state(),
             index,
             state_cache: VecDeque::with_capacity(max_rollback),
+            max_rollback,
         }
     }
 
@@ -62,6 +351,12 @@ impl PyGuide {
             )))
     }
 
+    /// Gets the only token allowed in the current state, or `None` if more than one token
+    /// is allowed. When a token is forced, masking the logits and sampling can be skipped.
+    fn get_forced_token(&self) -> Option<TokenId> {
+        self.index.0.forced_token(&self.state)
+    }
+
     /// Get the number of rollback steps available.
     fn get_allowed_rollback(&self) -> usize {
         self.state_cache.len()
@@ -76,12 +371,7 @@ impl PyGuide {
     ) -> PyResult<Option<Vec<TokenId>>> {
         match self.index.get_next_state(self.state, token_id) {
             Some(new_state) => {
-                // Free up space in state_cache if needed.
-                if self.state_cache.len() == self.state_cache.capacity() {
-                    self.state_cache.pop_front();
-                }
-                self.state_cache.push_back(self.state);
-                self.state = new_state;
+                self.move_to(new_state);
                 if return_tokens.unwrap_or(true) {
                     self.get_tokens().map(Some)
                 } else {
@@ -95,6 +385,70 @@ impl PyGuide {
         }
     }
 
+    /// Guide moves to the next state provided by the token id and writes the mask of allowed
+    /// tokens for that new state into the memory specified by data_ptr, like `write_mask_into`.
+    /// Unlike `advance`, no list of allowed tokens is built.
+    fn advance_and_write_mask(
+        &mut self,
+        py: Python<'_>,
+        token_id: TokenId,
+        data_ptr: usize,
+        numel: usize,
+        element_size: usize,
+    ) -> PyResult<()> {
+        // The buffer is checked first, so that the guide doesn't advance if it can't be written.
+        check_mask_buffer(
+            data_ptr,
+            numel,
+            element_size,
+            self.index.0.vocab_size().div_ceil(32),
+        )?;
+        self.advance(token_id, Some(false))?;
+        self.write_mask_into(py, data_ptr, numel, element_size)
+    }
+
+    /// Guide moves to the next state provided by the token id and writes the allowed tokens
+    /// for that new state into the memory specified by data_ptr, returning their number.
+    /// Unlike `advance`, no list is built: the caller owns the buffer and reuses it across
+    /// steps. The memory must be a contiguous array of 32-bit integers with room for all the
+    /// allowed tokens, `vocab_size` elements are always enough.
+    fn advance_into(
+        &mut self,
+        token_id: TokenId,
+        data_ptr: usize,
+        numel: usize,
+        element_size: usize,
+    ) -> PyResult<usize> {
+        let Some(new_state) = self.index.get_next_state(self.state, token_id) else {
+            return Err(PyValueError::new_err(format!(
+                "No next state found for the current state: {} with token ID: {token_id}",
+                self.state
+            )));
+        };
+        let index = &self.index.0;
+        let count = index
+            .state_transitions(&new_state)
+            .map_or(0, |transitions| transitions.len());
+        // The buffer is checked first, so that the guide doesn't advance if it can't be written.
+        check_mask_buffer(data_ptr, numel, element_size, 0)?;
+        if numel < count {
+            return Err(PyValueError::new_err(format!(
+                "Invalid buffer size: got {} elements, but {} tokens are allowed in the next state.",
+                numel, count
+            )));
+        }
+
+        let tokens = unsafe { std::slice::from_raw_parts_mut(data_ptr as *mut u32, numel) };
+        for (slot, &token) in tokens
+            .iter_mut()
+            .zip(index.allowed_tokens_iter(&new_state).into_iter().flatten())
+        {
+            *slot = token;
+        }
+        self.move_to(new_state);
+        Ok(count)
+    }
+
     /// Rollback the Guide state `n` tokens (states).
     /// Fails if `n` is greater than stored prior states.
     fn rollback_state(&mut self, n: usize) -> PyResult<()> {
@@ -105,7 +459,7 @@ impl PyGuide {
             return Err(PyValueError::new_err(format!(
                 "Cannot roll back {n} step(s): only {available} states stored (max_rollback = {cap}). \
                  You must advance through at least {n} state(s) before rolling back {n} step(s).",
-                 cap = self.state_cache.capacity(),
+                 cap = self.max_rollback,
                  available = self.get_allowed_rollback(),
             )));
         }
@@ -120,14 +474,7 @@ impl PyGuide {
 
     // Returns a boolean indicating if the sequence leads to a valid state in the DFA
     fn accepts_tokens(&self, sequence: Vec<u32>) -> bool {
-        let mut state = self.state;
-        for t in sequence {
-            match self.index.get_next_state(state, t) {
-                Some(s) => state = s,
-                None => return false,
-            }
-        }
-        true
+        self.index.0.accepts_tokens(&self.state, &sequence)
     }
 
     /// Checks if the automaton is in a final state.
@@ -141,47 +488,169 @@ impl PyGuide {
     ///
     /// `data_ptr` should be the data ptr to a `torch.tensor`, or `np.ndarray`, `mx.array` or other
     /// contiguous memory array.
-    fn write_mask_into(&self, data_ptr: usize, numel: usize, element_size: usize) -> PyResult<()> {
-        let expected_elements = self.index.0.vocab_size().div_ceil(32);
-        if element_size != 4 {
-            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
-                format!(
-                    "Invalid element size: got {} bytes per element, expected 4 bytes (32-bit integer).",
-                    element_size
-                ),
-            ));
-        } else if data_ptr == 0 {
-            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
-                "Invalid data pointer: received a null pointer.",
-            ));
-        } else if data_ptr % 4 != 0 {
-            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(format!(
-                "Invalid data pointer alignment: pointer address {} is not a multiple of 4.",
-                data_ptr
+    fn write_mask_into(
+        &self,
+        py: Python<'_>,
+        data_ptr: usize,
+        numel: usize,
+        element_size: usize,
+    ) -> PyResult<()> {
+        check_mask_buffer(
+            data_ptr,
+            numel,
+            element_size,
+            self.index.0.vocab_size().div_ceil(32),
+        )?;
+        // The mask is written without touching any Python object, so other threads
+        // can run (e.g. build an index or sample) while it is filled.
+        let index = &self.index.0;
+        let state = self.state;
+        py.allow_threads(|| {
+            let mask = unsafe { std::slice::from_raw_parts_mut(data_ptr as *mut u32, numel) };
+            index.write_mask_into(&state, mask);
+        });
+        Ok(())
+    }
+
+    /// Set the logits of the tokens not allowed in the current state to -inf, directly in
+    /// the memory specified by data_ptr, without going through a bitmask.
+    /// Size of the memory is indicated by `numel` (the number of logits) and `element_size`,
+    /// which must be 4 (float32) or 8 (float64).
+    ///
+    /// `data_ptr` should be the data ptr to a contiguous single-row CPU `torch.tensor`,
+    /// `np.ndarray` or other contiguous memory array.
+    fn mask_logits_into(
+        &self,
+        py: Python<'_>,
+        data_ptr: usize,
+        numel: usize,
+        element_size: usize,
+    ) -> PyResult<()> {
+        check_float_buffer(data_ptr, element_size)?;
+        let index = &self.index.0;
+        let state = self.state;
+        py.allow_threads(|| {
+            if element_size == 4 {
+                let logits = unsafe { std::slice::from_raw_parts_mut(data_ptr as *mut f32, numel) };
+                mask_logits(
+                    index,
+                    state,
+                    logits,
+                    f32::NEG_INFINITY,
+                    kernels::apply_token_bitmask_f32,
+                );
+            } else {
+                let logits = unsafe { std::slice::from_raw_parts_mut(data_ptr as *mut f64, numel) };
+                mask_logits(
+                    index,
+                    state,
+                    logits,
+                    f64::NEG_INFINITY,
+                    kernels::apply_token_bitmask_f64,
+                );
+            }
+        });
+        Ok(())
+    }
+
+    /// Sample the next token among the tokens allowed in the current state, with a probability
+    /// proportional to its weight in the memory specified by data_ptr, without advancing.
+    /// `u` is a uniform random number in [0, 1), e.g. `rng.random()`, so that sampling is seeded
+    /// by the caller. The result matches `rng.choice` over the masked and renormalized weights
+    /// for the same `u`.
+    ///
+    /// `data_ptr` should be the data ptr to a contiguous 1D array of `numel` non-negative
+    /// weights (e.g. probabilities), float32 or float64 as indicated by `element_size`.
+    fn sample_next_token(
+        &self,
+        py: Python<'_>,
+        data_ptr: usize,
+        numel: usize,
+        element_size: usize,
+        u: f64,
+    ) -> PyResult<TokenId> {
+        check_float_buffer(data_ptr, element_size)?;
+        if !(0.0..1.0).contains(&u) {
+            return Err(PyValueError::new_err(format!(
+                "Invalid uniform sample: got {}, expected a number in [0, 1).",
+                u
             )));
-        } else if numel < expected_elements {
-            return Err(PyErr::new::<pyo3::exceptions::PyValueError, _>(
-                format!(
-                    "Invalid buffer size: got {} elements ({} bytes), expected {} elements ({} bytes). \
-                    Ensure that the mask tensor has shape (1, (vocab_size + 31) // 32) and uses 32-bit integers.",
-                    numel,
-                    numel * element_size,
-                    expected_elements,
-                    expected_elements * 4
-                )
-            ));
         }
-        unsafe {
-            std::ptr::write_bytes(data_ptr as *mut u8, 0, numel * 4);
-        }
-        if let Some(tokens) = self.index.0.allowed_tokens_iter(&self.state) {
-            let slice = unsafe { std::slice::from_raw_parts_mut(data_ptr as *mut u32, numel) };
-            for &token in tokens {
-                let bucket = (token as usize) / 32;
-                if bucket < slice.len() {
-                    slice[bucket] |= 1 << ((token as usize) % 32);
-                }
+        let mask = self.index.0.state_mask(&self.state).unwrap_or_default();
+        let token = py.allow_threads(|| {
+            if element_size == 4 {
+                let probs = unsafe { std::slice::from_raw_parts(data_ptr as *const f32, numel) };
+                kernels::sample_token(mask, probs, u)
+            } else {
+                let probs = unsafe { std::slice::from_raw_parts(data_ptr as *const f64, numel) };
+                kernels::sample_token(mask, probs, u)
             }
+        });
+        token.ok_or_else(|| {
+            PyValueError::new_err(format!(
+                "No allowed token has a positive weight in the current state: {}",
+                self.state
+            ))
+        })
+    }
+
+    /// Write the masks of allowed tokens of a batch of guides into the memory specified by
+    /// data_ptr, one row per guide, with a single release of the GIL.
+    /// The memory must be a contiguous (len(guides), numel / len(guides)) array of 32-bit
+    /// integers, as returned by `allocate_token_bitmask(vocab_size, batch=len(guides))`.
+    #[staticmethod]
+    fn write_mask_into_batch(
+        py: Python<'_>,
+        guides: Vec<PyRef<'_, PyGuide>>,
+        data_ptr: usize,
+        numel: usize,
+        element_size: usize,
+    ) -> PyResult<()> {
+        let rows: Vec<(Arc<Index>, StateId)> = guides
+            .iter()
+            .map(|guide| (Arc::clone(&guide.index.0), guide.state))
+            .collect();
+        write_mask_rows(py, &rows, data_ptr, numel, element_size)
+    }
+
+    /// Advance a batch of guides, each by its token id, and write the masks of allowed tokens
+    /// of their new states into the memory specified by data_ptr, one row per guide, like
+    /// `write_mask_into_batch`. If any token isn't allowed, no guide is advanced.
+    #[staticmethod]
+    fn advance_and_write_mask_batch(
+        py: Python<'_>,
+        mut guides: Vec<PyRefMut<'_, PyGuide>>,
+        token_ids: Vec<TokenId>,
+        data_ptr: usize,
+        numel: usize,
+        element_size: usize,
+    ) -> PyResult<()> {
+        if guides.len() != token_ids.len() {
+            return Err(PyValueError::new_err(format!(
+                "Invalid batch size: got {} guides and {} token ids.",
+                guides.len(),
+                token_ids.len()
+            )));
+        }
+        let rows = guides
+            .iter()
+            .zip(&token_ids)
+            .map(
+                |(guide, &token_id)| match guide.index.get_next_state(guide.state, token_id) {
+                    Some(new_state) => Ok((Arc::clone(&guide.index.0), new_state)),
+                    None => Err(PyValueError::new_err(format!(
+                        "No next state found for the current state: {} with token ID: {token_id}",
+                        guide.state
+                    ))),
+                },
+            )
+            .collect::<PyResult<Vec<(Arc<Index>, StateId)>>>()?;
+
+        // The masks only depend on the new states, so they are written, and the buffer is
+        // checked, before any guide is advanced.
+        write_mask_rows(py, &rows, data_ptr, numel, element_size)?;
+        for (guide, (_, new_state)) in guides.iter_mut().zip(rows) {
+            guide.move_to(new_state);
         }
         Ok(())
     }
@@ -223,15 +692,29 @@ impl PyGuide {
     }
 
     #[staticmethod]
-    fn from_binary(binary_data: Vec<u8>) -> PyResult<Self> {
+    fn from_binary(binary_data: &[u8]) -> PyResult<Self> {
         let (guide, _): (PyGuide, usize) =
-            bincode::decode_from_slice(&binary_data[..], config::standard()).map_err(|e| {
+            bincode::decode_from_slice(binary_data, config::standard()).map_err(|e| {
                 PyErr::new::<PyValueError, _>(format!("Deserialization of Guide failed: {}", e))
             })?;
         Ok(guide)
     }
 }
 
+impl PyGuide {
+    /// Moves to `new_state`, keeping the current state for rollback.
+    fn move_to(&mut self, new_state: StateId) {
+        if self.max_rollback > 0 {
+            // Free up space in state_cache if needed.
+            if self.state_cache.len() == self.max_rollback {
+                self.state_cache.pop_front();
+            }
+            self.state_cache.push_back(self.state);
+        }
+        self.state = new_state;
+    }
+}
+
 /// Index object based on regex and vocabulary.
 #[pyclass(name = "Index", module = "outlines_core")]
 #[derive(Clone, Debug, PartialEq, Encode, Decode)]
@@ -266,12 +749,18 @@ impl PyIndex {
 
     /// Get all final states.
     fn get_final_states(&self) -> HashSet<StateId> {
-        self.0.final_states().clone()
+        self.0.final_states()
     }
 
     /// Returns the Index as a Python Dict object.
     fn get_transitions(&self) -> HashMap<StateId, HashMap<TokenId, StateId>> {
-        self.0.transitions().clone()
+        self.0.transitions()
+    }
+
+    /// Returns the transitions of a state, as a dict of token ids to next states, or None if
+    /// the state has no transitions. Unlike `get_transitions`, only that state is converted.
+    fn get_state_transitions(&self, state: StateId) -> Option<HashMap<TokenId, StateId>> {
+        self.0.state_transitions(&state).cloned()
     }
 
     /// Returns the ID of the initial state of the index.
@@ -291,7 +780,8 @@ impl PyIndex {
 
     /// Compares whether two indexes are the same.
     fn __eq__(&self, other: &PyIndex) -> bool {
-        *self.0 == *other.0
+        // Compares the shared `Arc`s, which short-circuits when both point to the same Index.
+        self.0 == other.0
     }
 
     /// Makes a deep copy of the Index.
@@ -311,9 +801,9 @@ impl PyIndex {
     }
 
     #[staticmethod]
-    fn from_binary(binary_data: Vec<u8>) -> PyResult<Self> {
+    fn from_binary(binary_data: &[u8]) -> PyResult<Self> {
         let (index, _): (Index, usize) =
-            bincode::decode_from_slice(&binary_data[..], config::standard()).map_err(|e| {
+            bincode::decode_from_slice(binary_data, config::standard()).map_err(|e| {
                 PyErr::new::<PyValueError, _>(format!("Deserialization of Index failed: {}", e))
             })?;
         Ok(PyIndex(Arc::new(index)))
@@ -322,32 +812,67 @@ impl PyIndex {
 
 /// LLM vocabulary.
 #[pyclass(name = "Vocabulary", module = "outlines_core")]
-#[derive(Clone, Debug, Encode, Decode)]
-pub struct PyVocabulary(Vocabulary);
+#[derive(Clone, Debug)]
+pub struct PyVocabulary(
+    /// Shared with the copies of the vocabulary until one of them is modified, so that copies
+    /// are cheap and compare equal to the original by identity.
+    Arc<Vocabulary>,
+    /// The `content_hash` of the vocabulary, computed once and reset when it is modified.
+    OnceCell<u64>,
+);
+
+impl PyVocabulary {
+    fn new(vocabulary: Vocabulary) -> Self {
+        PyVocabulary(Arc::new(vocabulary), OnceCell::new())
+    }
+
+    /// Returns the vocabulary to modify, unshared from its copies, and resets its hash.
+    fn make_mut(&mut self) -> &mut Vocabulary {
+        self.1 = OnceCell::new();
+        Arc::make_mut(&mut self.0)
+    }
+}
 
 #[pymethods]
 impl PyVocabulary {
     /// Creates a vocabulary from eos token id and a map of tokens to token ids.
     #[new]
     fn __new__(py: Python<'_>, eos_token_id: TokenId, map: Py<PyAny>) -> PyResult<PyVocabulary> {
-        if let Ok(dict) = map.extract::<HashMap<String, Vec<TokenId>>>(py) {
-            return Ok(PyVocabulary(Vocabulary::try_from((eos_token_id, dict))?));
-        }
-        if let Ok(dict) = map.extract::<HashMap<Vec<u8>, Vec<TokenId>>>(py) {
-            return Ok(PyVocabulary(Vocabulary::try_from((eos_token_id, dict))?));
-        }
-
         let message = "Expected a dict with keys of type str or bytes and values of type list[int]";
-        let tname = type_name!(map).to_string_lossy();
-        if tname == "dict" {
-            Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(format!(
-                "Dict keys or/and values of the wrong types. {message}"
-            )))
-        } else {
-            Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(format!(
+        let Ok(dict) = map.downcast_bound::<PyDict>(py) else {
+            let tname = type_name!(map).to_string_lossy();
+            return Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(format!(
                 "{message}, got {tname}"
-            )))
+            )));
+        };
+        let wrong_types = || {
+            PyErr::new::<pyo3::exceptions::PyTypeError, _>(format!(
+                "Dict keys or/and values of the wrong types. {message}"
+            ))
+        };
+
+        // Keys are either all str or all bytes, so the type of the first key is checked once
+        // and the others are only downcast to it.
+        let str_keys = dict
+            .iter()
+            .next()
+            .is_none_or(|(key, _)| key.is_instance_of::<PyString>());
+        let mut tokens: Vec<(Token, Vec<TokenId>)> = Vec::with_capacity(dict.len());
+        for (key, value) in dict.iter() {
+            let token = if str_keys {
+                let key = key.downcast::<PyString>().map_err(|_| wrong_types())?;
+                key.to_str().map_err(|_| wrong_types())?.as_bytes().to_vec()
+            } else {
+                let key = key.downcast::<PyBytes>().map_err(|_| wrong_types())?;
+                key.as_bytes().to_vec()
+            };
+            let ids = value.extract::<Vec<TokenId>>().map_err(|_| wrong_types())?;
+            tokens.push((token, ids));
         }
+        Ok(PyVocabulary::new(Vocabulary::try_from_tokens(
+            eos_token_id,
+            tokens,
+        )?))
     }
 
     /// Creates the vocabulary of a pre-trained model.
@@ -366,17 +891,17 @@ impl PyVocabulary {
         if token.is_some() {
             params.token = token
         }
-        let v = Vocabulary::from_pretrained(model.as_str(), Some(params))?;
-        Ok(PyVocabulary(v))
+        let v = Vocabulary::from_pretrained_cached(model.as_str(), Some(params))?;
+        Ok(PyVocabulary::new(v))
     }
 
     /// Inserts new token with token_id or extends list of token_ids if token already present.
     fn insert(&mut self, py: Python<'_>, token: Py<PyAny>, token_id: TokenId) -> PyResult<()> {
         if let Ok(t) = token.extract::<String>(py) {
-            return Ok(self.0.try_insert(t, token_id)?);
+            return Ok(self.make_mut().try_insert(t, token_id)?);
         }
         if let Ok(t) = token.extract::<Token>(py) {
-            return Ok(self.0.try_insert(t, token_id)?);
+            return Ok(self.make_mut().try_insert(t, token_id)?);
         }
         Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(format!(
             "Expected a token of type str or bytes, got {:?}",
@@ -385,33 +910,20 @@ impl PyVocabulary {
     }
 
     /// Removes a token from vocabulary.
-    fn remove(&mut self, py: Python<'_>, token: Py<PyAny>) -> PyResult<()> {
-        if let Ok(t) = token.extract::<String>(py) {
-            self.0.remove(t);
-            return Ok(());
-        }
-        if let Ok(t) = token.extract::<Token>(py) {
-            self.0.remove(t);
-            return Ok(());
-        }
-        Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(format!(
-            "Expected a token of type str or bytes, got {:?}",
-            type_name!(token)
-        )))
+    fn remove(&mut self, token: &Bound<'_, PyAny>) -> PyResult<()> {
+        with_token_bytes(token, |token| self.make_mut().remove(token))
     }
 
     /// Gets token ids of a given token.
-    fn get(&self, py: Python<'_>, token: Py<PyAny>) -> PyResult<Option<Vec<TokenId>>> {
-        if let Ok(t) = token.extract::<String>(py) {
-            return Ok(self.0.token_ids(t.into_bytes()).cloned());
-        }
-        if let Ok(t) = token.extract::<Token>(py) {
-            return Ok(self.0.token_ids(&t).cloned());
-        }
-        Err(PyErr::new::<pyo3::exceptions::PyTypeError, _>(format!(
-            "Expected a token of type str or bytes, got {:?}",
-            type_name!(token)
-        )))
+    fn get<'py>(&self, token: &Bound<'py, PyAny>) -> PyResult<Option<Bound<'py, PyList>>> {
+        // The list is built from the ids in place, without copying them into a `Vec` first.
+        let py = token.py();
+        with_token_bytes(token, |token| {
+            self.0
+                .token_ids(token)
+                .map(|ids| PyList::new(py, ids))
+                .transpose()
+        })?
     }
 
     /// Gets the end of sentence token id.
@@ -431,7 +943,16 @@ impl PyVocabulary {
 
     /// Compares whether two vocabularies are the same.
     fn __eq__(&self, other: &PyVocabulary) -> bool {
-        self.0 == other.0
+        Arc::ptr_eq(&self.0, &other.0) || self.0 == other.0
+    }
+
+    /// Hashes the content of the vocabulary, consistently with `__eq__`.
+    ///
+    /// The hash is computed on the first call and cached until the vocabulary is modified.
+    /// Since `insert` and `remove` change it, a vocabulary must not be modified while it is
+    /// stored in a `dict` or a `set`, which would no longer find it.
+    fn __hash__(&self) -> u64 {
+        *self.1.get_or_init(|| self.0.content_hash())
     }
 
     /// Returns length of Vocabulary's tokens, excluding EOS token.
@@ -439,39 +960,52 @@ impl PyVocabulary {
         self.0.len()
     }
 
-    /// Makes a deep copy of the Vocabulary.
+    /// Makes a deep copy of the Vocabulary, which shares its tokens until either is modified.
     fn __deepcopy__(&self, _py: Python<'_>, _memo: Py<PyDict>) -> Self {
-        PyVocabulary(self.0.clone())
+        self.clone()
     }
 
     fn __reduce__(&self) -> PyResult<(PyObject, (Vec<u8>,))> {
         Python::with_gil(|py| {
             let cls = PyModule::import(py, "outlines_core")?.getattr("Vocabulary")?;
-            let binary_data: Vec<u8> =
-                bincode::encode_to_vec(self, config::standard()).map_err(|e| {
-                    PyErr::new::<PyValueError, _>(format!(
-                        "Serialization of Vocabulary failed: {}",
-                        e
-                    ))
-                })?;
+            let binary_data: Vec<u8> = bincode::encode_to_vec(
+                self.0.compacted().as_ref(),
+                config::standard(),
+            )
+            .map_err(|e| {
+                PyErr::new::<PyValueError, _>(format!("Serialization of Vocabulary failed: {}", e))
+            })?;
             Ok((cls.getattr("from_binary")?.unbind(), (binary_data,)))
         })
     }
 
     #[staticmethod]
-    fn from_binary(binary_data: Vec<u8>) -> PyResult<Self> {
-        let (guide, _): (PyVocabulary, usize) =
-            bincode::decode_from_slice(&binary_data[..], config::standard()).map_err(|e| {
+    fn from_binary(binary_data: &[u8]) -> PyResult<Self> {
+        let (vocabulary, _): (Vocabulary, usize) =
+            bincode::decode_from_slice(binary_data, config::standard()).map_err(|e| {
                 PyErr::new::<PyValueError, _>(format!(
                     "Deserialization of Vocabulary failed: {}",
                     e
                 ))
             })?;
-        Ok(guide)
+        Ok(PyVocabulary::new(vocabulary))
     }
 }
 
+/// The maximum number of regexes kept by `build_regex_from_schema`.
+const SCHEMA_REGEX_CACHE_SIZE: usize = 1024;
+
+/// The arguments of `build_regex_from_schema`, which its memoized regexes are keyed by.
+type SchemaRegexKey = (String, Option<String>, usize);
+
+/// Regexes built from JSON schemas.
+static SCHEMA_REGEXES: Lazy<Mutex<FifoCache<SchemaRegexKey, String>>> =
+    Lazy::new(|| Mutex::new(FifoCache::new(SCHEMA_REGEX_CACHE_SIZE)));
+
 /// Creates regex string from JSON schema with optional whitespace pattern.
+///
+/// Regexes are memoized per schema string, whitespace pattern and recursion depth, since the
+/// same schemas tend to be converted again and again.
 #[pyfunction(name = "build_regex_from_schema")]
 #[pyo3(signature = (json_schema, whitespace_pattern=None, max_recursion_depth=3))]
 pub fn build_regex_from_schema_py(
@@ -479,11 +1013,30 @@ pub fn build_regex_from_schema_py(
     whitespace_pattern: Option<&str>,
     max_recursion_depth: usize,
 ) -> PyResult<String> {
-    let value = serde_json::from_str(&json_schema).map_err(|_| {
+    let key = (
+        json_schema,
+        whitespace_pattern.map(str::to_owned),
+        max_recursion_depth,
+    );
+    if let Some(regex) = SCHEMA_REGEXES
+        .lock()
+        .ok()
+        .and_then(|r| r.get(&key).cloned())
+    {
+        return Ok(regex);
+    }
+
+    let value = serde_json::from_str(&key.0).map_err(|_| {
         PyErr::new::<pyo3::exceptions::PyTypeError, _>("Expected a valid JSON string.")
     })?;
-    json_schema::regex_from_value(&value, whitespace_pattern, Some(max_recursion_depth))
-        .map_err(|e| PyValueError::new_err(e.to_string()))
+    let regex =
+        json_schema::regex_from_value(&value, whitespace_pattern, Some(max_recursion_depth))
+            .map_err(|e| PyValueError::new_err(e.to_string()))?;
+
+    if let Ok(mut regexes) = SCHEMA_REGEXES.lock() {
+        regexes.insert(key, regex.clone());
+    }
+    Ok(regex)
 }
 
 fn register_child_module(parent_module: &Bound<'_, PyModule>) -> PyResult<()> {
@@ -526,6 +1079,7 @@ fn outlines_core(m: &Bound<'_, PyModule>) -> PyResult<()> {
     m.add_class::<PyIndex>()?;
     m.add_class::<PyVocabulary>()?;
     m.add_class::<PyGuide>()?;
+    m.add_function(wrap_pyfunction!(apply_token_bitmask_inplace, m)?)?;
     register_child_module(m)?;
 
     Ok(())
@@ -0,0 +1,202 @@
+//! Caches vocabularies built from pretrained models, in process and on disk.
+//!
+//! Building a `Vocabulary` from a pretrained tokenizer processes every token of
+//! it, so the result is memoized per model and revision. The disk cache is opt-in,
+//! enabled by setting `OUTLINES_CORE_CACHE_DIR`, and only holds revisions pinned
+//! to a commit, which can't move. Cache files hold the bincode encoding of the key
+//! and the vocabulary, compressed with zlib, and are written atomically. An
+//! unreadable, oversized or mismatching cache file is ignored and the vocabulary
+//! is built again.
+
+use std::fs::{self, File};
+use std::io::{BufReader, BufWriter, Read, Write};
+use std::path::PathBuf;
+use std::sync::{Arc, Mutex};
+
+use flate2::read::ZlibDecoder;
+use flate2::write::ZlibEncoder;
+use flate2::Compression;
+use once_cell::sync::Lazy;
+use rustc_hash::FxHashMap as HashMap;
+
+use super::Vocabulary;
+
+/// Environment variable setting the cache directory, and enabling the disk cache.
+const CACHE_DIR_ENV: &str = "OUTLINES_CORE_CACHE_DIR";
+
+/// Bumped whenever the encoding of `Vocabulary` changes, to ignore stale files.
+const FORMAT_VERSION: u32 = 3;
+
+/// Upper bound of the decompressed size of a cache file.
+const MAX_DECOMPRESSED_SIZE: u64 = 64 * 1024 * 1024;
+
+static VOCABULARIES: Lazy<Mutex<HashMap<String, Arc<Vocabulary>>>> =
+    Lazy::new(|| Mutex::new(HashMap::default()));
+
+/// Returns the cache key of a model at a revision.
+pub(super) fn key(model: &str, revision: &str) -> String {
+    format!("{model}@{revision}")
+}
+
+/// Returns whether `revision` is a commit hash, whose files never change, unlike
+/// a branch or a tag.
+pub(super) fn is_commit(revision: &str) -> bool {
+    revision.len() == 40
+        && revision
+            .bytes()
+            .all(|b| matches!(b, b'0'..=b'9' | b'a'..=b'f'))
+}
+
+/// Returns the cached vocabulary for `key`, from memory or else, if `on_disk`,
+/// from disk.
+pub(super) fn get(key: &str, on_disk: bool) -> Option<Vocabulary> {
+    if let Some(vocabulary) = VOCABULARIES.lock().ok()?.get(key) {
+        return Some(Vocabulary::clone(vocabulary));
+    }
+    if !on_disk {
+        return None;
+    }
+    let vocabulary = load(key)?;
+    if let Ok(mut vocabularies) = VOCABULARIES.lock() {
+        vocabularies.insert(key.to_string(), Arc::new(vocabulary.clone()));
+    }
+    Some(vocabulary)
+}
+
+/// Caches `vocabulary` under `key`, in memory and, if `on_disk`, on disk.
+pub(super) fn insert(key: &str, vocabulary: &Vocabulary, on_disk: bool) {
+    if let Ok(mut vocabularies) = VOCABULARIES.lock() {
+        vocabularies.insert(key.to_string(), Arc::new(vocabulary.clone()));
+    }
+    if on_disk {
+        // The disk cache is best effort, a failed write only costs a rebuild later.
+        let _ = store(key, vocabulary);
+    }
+}
+
+/// Returns the cache directory, `$OUTLINES_CORE_CACHE_DIR`, or `None` if it isn't
+/// set and the disk cache is disabled.
+fn cache_dir() -> Option<PathBuf> {
+    std::env::var_os(CACHE_DIR_ENV)
+        .filter(|dir| !dir.is_empty())
+        .map(PathBuf::from)
+}
+
+/// Returns the path of the cache file of `key`.
+fn cache_path(key: &str) -> Option<PathBuf> {
+    let name: String = key
+        .chars()
+        .map(|c| match c {
+            'a'..='z' | 'A'..='Z' | '0'..='9' | '.' | '-' | '_' => c,
+            _ => '_',
+        })
+        .collect();
+    Some(cache_dir()?.join(format!("vocab-{name}.bin")))
+}
+
+fn load(key: &str) -> Option<Vocabulary> {
+    let file = File::open(cache_path(key)?).ok()?;
+    // Decoded straight from the decompressed stream, without buffering the whole file, and
+    // with a bound on the bytes read and on the allocations made by decoding.
+    let mut reader = ZlibDecoder::new(BufReader::new(file)).take(MAX_DECOMPRESSED_SIZE);
+    let config = bincode::config::standard().with_limit::<{ MAX_DECOMPRESSED_SIZE as usize }>();
+
+    // Stale files are rejected before decoding the vocabulary. The key is stored along with
+    // the vocabulary, since sanitized file names of distinct keys may clash.
+    let version: u32 = bincode::decode_from_std_read(&mut reader, config).ok()?;
+    let stored_key: String = bincode::decode_from_std_read(&mut reader, config).ok()?;
+    if version != FORMAT_VERSION || stored_key != key {
+        return None;
+    }
+    bincode::decode_from_std_read(&mut reader, config).ok()
+}
+
+fn store(key: &str, vocabulary: &Vocabulary) -> std::io::Result<()> {
+    let path = cache_path(key).ok_or(std::io::ErrorKind::NotFound)?;
+    if let Some(dir) = path.parent() {
+        fs::create_dir_all(dir)?;
+    }
+    // Written next to the final file and renamed, so that concurrent readers
+    // never see a partial file.
+    let tmp_path = path.with_extension(format!("tmp{}", std::process::id()));
+    let result = (|| {
+        let mut encoder = ZlibEncoder::new(
+            BufWriter::new(File::create(&tmp_path)?),
+            Compression::fast(),
+        );
+        bincode::encode_into_std_write(
+            (FORMAT_VERSION, key, vocabulary.compacted().as_ref()),
+            &mut encoder,
+            bincode::config::standard(),
+        )
+        .map_err(|e| std::io::Error::other(e.to_string()))?;
+        encoder.finish()?.flush()?;
+        fs::rename(&tmp_path, &path)
+    })();
+    if result.is_err() {
+        let _ = fs::remove_file(&tmp_path);
+    }
+    result
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn vocabulary() -> Vocabulary {
+        let mut vocabulary = Vocabulary::new(3);
+        for (token, id) in [("zero", 0), ("one", 1), ("two", 2)] {
+            vocabulary.try_insert(token, id).expect("Insert failed");
+        }
+        vocabulary
+    }
+
+    // The only test setting the cache directory, since the environment is shared by tests
+    // running concurrently.
+    #[test]
+    fn disk_cache() {
+        let dir = std::env::temp_dir().join(format!("outlines-core-cache-{}", std::process::id()));
+        let vocabulary = vocabulary();
+        let commit = "0123456789abcdef0123456789abcdef01234567";
+
+        // Disabled unless the cache directory is set.
+        std::env::remove_var(CACHE_DIR_ENV);
+        insert(&key("org/disabled", commit), &vocabulary, true);
+        assert!(cache_path(&key("org/disabled", commit)).is_none());
+
+        std::env::set_var(CACHE_DIR_ENV, &dir);
+
+        // Miss, then hit once stored.
+        let pinned = key("org/model", commit);
+        assert!(load(&pinned).is_none());
+        assert!(get(&pinned, true).is_none());
+        insert(&pinned, &vocabulary, true);
+        assert_eq!(load(&pinned), Some(vocabulary.clone()));
+
+        // A clashing file name doesn't return the vocabulary of another key.
+        assert!(load(&key("org_model", commit)).is_none());
+
+        // A moving revision is kept in memory only, and never read from disk.
+        let branch = key("org/model", "main");
+        store(&branch, &vocabulary).expect("Store failed");
+        assert!(get(&branch, false).is_none());
+        insert(&branch, &vocabulary, false);
+        assert_eq!(get(&branch, false), Some(vocabulary));
+
+        let _ = fs::remove_dir_all(dir);
+        std::env::remove_var(CACHE_DIR_ENV);
+    }
+
+    #[test]
+    fn commit_revisions() {
+        assert!(is_commit("607a30d783dfa663caf39e06633721c8d4cfcd7e"));
+        for revision in [
+            "main",
+            "v1.0",
+            "607a30d",
+            "607A30D783DFA663CAF39E06633721C8D4CFCD7E",
+        ] {
+            assert!(!is_commit(revision));
+        }
+    }
+}
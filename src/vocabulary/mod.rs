@@ -1,11 +1,14 @@
 //! Creates `Vocabulary` manually or from pretrained large language model.
 
+use std::borrow::Cow;
+use std::hash::{Hash, Hasher};
+
 use bincode::{Decode, Encode};
 #[cfg(feature = "hugginface-hub")]
 use locator::{HFLocator, Locator};
 #[cfg(feature = "hugginface-hub")]
 use processor::TokenProcessor;
-use rustc_hash::FxHashMap as HashMap;
+use rustc_hash::{FxHashMap as HashMap, FxHasher};
 #[cfg(feature = "hugginface-hub")]
 use tokenizers::normalizers::Sequence;
 #[cfg(feature = "hugginface-hub")]
@@ -14,6 +17,8 @@ use tokenizers::{NormalizerWrapper, Tokenizer};
 use crate::prelude::*;
 use crate::{Error, Result};
 
+#[cfg(feature = "hugginface-hub")]
+mod cache;
 #[cfg(feature = "hugginface-hub")]
 mod locator;
 #[cfg(feature = "hugginface-hub")]
@@ -53,7 +58,7 @@ mod processor;
 /// let mut vocabulary = Vocabulary::new(eos_token_id);
 ///
 /// vocabulary.try_insert("token", 0).expect("New token inserted");
-/// assert_eq!(vocabulary.token_ids("token"), Some(&vec![0]));
+/// assert_eq!(vocabulary.token_ids("token"), Some(&[0][..]));
 /// assert_eq!(vocabulary.tokens().len(), 1);
 /// assert_eq!(vocabulary.eos_token_id(), eos_token_id);
 ///
@@ -62,10 +67,15 @@ mod processor;
 /// ```
 "##
 )]
-#[derive(Clone, Debug, Default, PartialEq, Encode, Decode)]
+#[derive(Clone, Default, Encode, Decode)]
 pub struct Vocabulary {
     eos_token_id: TokenId,
-    tokens: HashMap<Token, Vec<TokenId>>,
+    /// The token ids of each token: `(id, 1)` for a token with a single id, which is most of
+    /// them, otherwise the `(offset, len)` range of `ids` holding its ids.
+    tokens: HashMap<Token, (u32, u32)>,
+    /// The token ids of all tokens with several ids, stored contiguously instead of in a `Vec`
+    /// per token. Ranges of removed tokens, or moved when a token id was added, are left unused.
+    ids: Vec<TokenId>,
 }
 
 impl Vocabulary {
@@ -74,7 +84,31 @@ impl Vocabulary {
         Self {
             eos_token_id,
             tokens: HashMap::default(),
+            ids: Vec::new(),
+        }
+    }
+
+    /// Creates a vocabulary from tokens and their token ids, none of which may be the eos token.
+    pub(crate) fn try_from_tokens(
+        eos_token_id: TokenId,
+        tokens: impl IntoIterator<Item = (Token, Vec<TokenId>)>,
+    ) -> Result<Self> {
+        let mut vocabulary = Self::new(eos_token_id);
+        for (token, ids) in tokens {
+            if ids.contains(&eos_token_id) {
+                return Err(Error::EOSTokenDisallowed);
+            }
+            let range = match ids[..] {
+                [id] => (id, 1),
+                _ => {
+                    let offset = vocabulary.ids.len() as u32;
+                    vocabulary.ids.extend_from_slice(&ids);
+                    (offset, ids.len() as u32)
+                }
+            };
+            vocabulary.tokens.insert(token, range);
         }
+        Ok(vocabulary)
     }
 
     /// Creates the vocabulary of pre-trained model from Hugging Face Hub.
@@ -86,6 +120,32 @@ impl Vocabulary {
         Self::from_pretrained_with_locator::<HFLocator>(model, parameters)
     }
 
+    /// Creates the vocabulary of pre-trained model from Hugging Face Hub, like
+    /// `from_pretrained`, memoizing it per model and revision in process.
+    ///
+    /// Revisions pinned to a commit hash are also cached on disk, when
+    /// `$OUTLINES_CORE_CACHE_DIR` is set. Other revisions, such as the default
+    /// `main`, may move, so they are only memoized for the process. Vocabularies
+    /// fetched with an auth token are never cached.
+    #[cfg(feature = "hugginface-hub")]
+    pub fn from_pretrained_cached(
+        model: &str,
+        parameters: Option<FromPretrainedParameters>,
+    ) -> Result<Self> {
+        if parameters.as_ref().is_some_and(|p| p.token.is_some()) {
+            return Self::from_pretrained(model, parameters);
+        }
+        let revision = parameters.as_ref().map_or("main", |p| p.revision.as_str());
+        let on_disk = cache::is_commit(revision);
+        let key = cache::key(model, revision);
+        if let Some(vocabulary) = cache::get(&key, on_disk) {
+            return Ok(vocabulary);
+        }
+        let vocabulary = Self::from_pretrained(model, parameters)?;
+        cache::insert(&key, &vocabulary, on_disk);
+        Ok(vocabulary)
+    }
+
     #[doc(hidden)]
     #[inline(always)]
     #[cfg(feature = "hugginface-hub")]
@@ -105,8 +165,13 @@ impl Vocabulary {
             });
         };
 
-        // Start building the vocabulary from eos_token_id and added tokens.
+        // Start building the vocabulary from eos_token_id and added tokens, with room for every
+        // token of the tokenizer. Tokens with a single id don't use `ids`.
+        let vocab = tokenizer.get_vocab(false);
         let mut vocabulary = Vocabulary::new(eos_token_id);
+        vocabulary
+            .tokens
+            .reserve(vocab.len() + tokenizer.get_added_tokens_decoder().len());
         for (id, added_token) in tokenizer.get_added_tokens_decoder().iter() {
             if !added_token.special && id != &eos_token_id {
                 vocabulary.try_insert(added_token.content.clone(), *id)?
@@ -120,24 +185,72 @@ impl Vocabulary {
                 reason: "Token processor".to_string(),
             });
         };
-        for (token, token_id) in tokenizer.get_vocab(false) {
+        for (token, token_id) in vocab {
             if token_id != eos_token_id {
                 let processed_token = processor.process(&token)?;
                 vocabulary.try_insert(processed_token, token_id)?;
             }
         }
 
+        // Tokens processed into the same bytes had their ids moved, leaving unused ranges.
+        vocabulary.compact();
         Ok(vocabulary)
     }
 
     /// Returns all tokens with their token ids in vocabulary.
-    pub fn tokens(&self) -> &HashMap<Token, Vec<TokenId>> {
-        &self.tokens
+    pub fn tokens(&self) -> impl ExactSizeIterator<Item = (&Token, &[TokenId])> + '_ {
+        self.tokens
+            .iter()
+            .map(|(token, range)| (token, self.ids_of(range)))
     }
 
     /// Returns all token ids per provided token if available in the vocabulary.
-    pub fn token_ids(&self, token: impl AsRef<[u8]>) -> Option<&Vec<TokenId>> {
-        self.tokens.get(token.as_ref())
+    pub fn token_ids(&self, token: impl AsRef<[u8]>) -> Option<&[TokenId]> {
+        self.tokens
+            .get(token.as_ref())
+            .map(|range| self.ids_of(range))
+    }
+
+    fn ids_of<'a>(&'a self, range: &'a (u32, u32)) -> &'a [TokenId] {
+        match *range {
+            (_, 1) => std::slice::from_ref(&range.0),
+            (offset, len) => &self.ids[offset as usize..(offset + len) as usize],
+        }
+    }
+
+    /// Returns the number of ids of `ids` used by tokens.
+    fn used_ids(&self) -> usize {
+        self.tokens
+            .values()
+            .filter(|&&(_, len)| len != 1)
+            .map(|&(_, len)| len as usize)
+            .sum()
+    }
+
+    /// Drops the unused ranges of `ids`, storing the ids of every token contiguously again.
+    fn compact(&mut self) {
+        let used = self.used_ids();
+        if used == self.ids.len() {
+            return;
+        }
+        let mut ids = Vec::with_capacity(used);
+        for (offset, len) in self.tokens.values_mut().filter(|(_, len)| *len != 1) {
+            let start = *offset as usize;
+            *offset = ids.len() as u32;
+            ids.extend_from_slice(&self.ids[start..start + *len as usize]);
+        }
+        self.ids = ids;
+    }
+
+    /// Returns the vocabulary without unused ranges in its token ids storage, e.g. left by
+    /// removed tokens, copying it only if it has some. Used before encoding it.
+    pub fn compacted(&self) -> Cow<'_, Self> {
+        if self.used_ids() == self.ids.len() {
+            return Cow::Borrowed(self);
+        }
+        let mut vocabulary = self.clone();
+        vocabulary.compact();
+        Cow::Owned(vocabulary)
     }
 
     /// Gets the identifier of the special end of the sentence token.
@@ -151,25 +264,74 @@ impl Vocabulary {
             return Err(Error::EOSTokenDisallowed);
         }
         let token = token.into();
-        self.tokens.entry(token).or_default().push(id);
+        let end = self.ids.len() as u32;
+        match self.tokens.get_mut(&token) {
+            // A token created without ids gets the new one inline, its empty range could
+            // otherwise be read as an inline id once extended to a length of 1.
+            Some((first_id, len @ 0)) => {
+                *first_id = id;
+                *len = 1;
+                return Ok(());
+            }
+            // The single id of the token moves to `ids`, along with the new one.
+            Some((first_id, len @ 1)) => {
+                self.ids.push(*first_id);
+                *first_id = end;
+                *len = 2;
+            }
+            // The ids of the token are at the end of `ids`, they can be extended in place.
+            Some((offset, len)) if *offset + *len == end => *len += 1,
+            Some((offset, len)) => {
+                let start = *offset as usize;
+                self.ids.extend_from_within(start..start + *len as usize);
+                *offset = end;
+                *len += 1;
+            }
+            None => {
+                self.tokens.insert(token, (id, 1));
+                return Ok(());
+            }
+        }
+        self.ids.push(id);
         Ok(())
     }
 
     /// Removes a given token from the vocabulary.
-    pub fn remove(&mut self, token: impl Into<Token>) {
-        let token = token.into();
-        self.tokens.remove(&token);
+    pub fn remove(&mut self, token: impl AsRef<[u8]>) {
+        self.tokens.remove(token.as_ref());
     }
 
     pub fn len(&self) -> usize {
         // +1 for eos_token_id which is not in self.tokens map.
-        self.tokens.values().map(|ids| ids.len()).sum::<usize>() + 1
+        self.tokens
+            .values()
+            .map(|&(_, len)| len as usize)
+            .sum::<usize>()
+            + 1
     }
 
     pub fn is_empty(&self) -> bool {
         self.tokens.is_empty()
     }
 
+    /// Returns a hash of the vocabulary content, consistent with equality: vocabularies with the
+    /// same eos token and tokens have the same hash, regardless of their insertion order.
+    pub fn content_hash(&self) -> u64 {
+        // Token entries are hashed independently and combined with a commutative operation,
+        // since the iteration order of the map depends on its insertion history.
+        let tokens_hash = self.tokens().fold(0u64, |acc, (token, ids)| {
+            let mut hasher = FxHasher::default();
+            token.hash(&mut hasher);
+            ids.hash(&mut hasher);
+            acc.wrapping_add(hasher.finish())
+        });
+        let mut hasher = FxHasher::default();
+        self.eos_token_id.hash(&mut hasher);
+        self.tokens.len().hash(&mut hasher);
+        tokens_hash.hash(&mut hasher);
+        hasher.finish()
+    }
+
     /// Filters out `Prepend` kind of tokenizer's normalizers.
     #[cfg(feature = "hugginface-hub")]
     fn filter_prepend_normalizers(tokenizer: &mut Tokenizer) {
@@ -209,7 +371,7 @@ impl std::fmt::Display for Vocabulary {
             "Vocabulary object with eos_token_id={:?} and the following tokens to token_ids:",
             self.eos_token_id
         )?;
-        for (token, token_ids) in self.tokens.iter() {
+        for (token, token_ids) in self.tokens() {
             writeln!(
                 f,
                 "{:?} -> {:?}",
@@ -224,18 +386,40 @@ impl std::fmt::Display for Vocabulary {
     }
 }
 
+/// Shows the token ids of each token, rather than how they are stored.
+impl std::fmt::Debug for Vocabulary {
+    fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+        struct Tokens<'a>(&'a Vocabulary);
+
+        impl std::fmt::Debug for Tokens<'_> {
+            fn fmt(&self, f: &mut std::fmt::Formatter<'_>) -> std::fmt::Result {
+                f.debug_map().entries(self.0.tokens()).finish()
+            }
+        }
+
+        f.debug_struct("Vocabulary")
+            .field("eos_token_id", &self.eos_token_id)
+            .field("tokens", &Tokens(self))
+            .finish()
+    }
+}
+
+impl PartialEq for Vocabulary {
+    fn eq(&self, other: &Self) -> bool {
+        self.eos_token_id == other.eos_token_id
+            && self.tokens.len() == other.tokens.len()
+            && self
+                .tokens()
+                .all(|(token, ids)| other.token_ids(token) == Some(ids))
+    }
+}
+
 impl TryFrom<(TokenId, HashMap<Token, Vec<TokenId>>)> for Vocabulary {
     type Error = Error;
 
     fn try_from(values: (TokenId, HashMap<Token, Vec<TokenId>>)) -> Result<Self, Self::Error> {
         let (eos_token_id, tokens) = values;
-        if tokens.iter().any(|(_, ids)| ids.contains(&eos_token_id)) {
-            return Err(Error::EOSTokenDisallowed);
-        }
-        Ok(Vocabulary {
-            eos_token_id,
-            tokens,
-        })
+        Vocabulary::try_from_tokens(eos_token_id, tokens)
     }
 }
 
@@ -244,19 +428,10 @@ impl TryFrom<(TokenId, HashMap<String, Vec<TokenId>>)> for Vocabulary {
 
     fn try_from(values: (TokenId, HashMap<String, Vec<TokenId>>)) -> Result<Self, Self::Error> {
         let (eos_token_id, tokens) = values;
-        Ok(Vocabulary {
+        Vocabulary::try_from_tokens(
             eos_token_id,
-            tokens: tokens
-                .into_iter()
-                .map(|(k, v)| {
-                    if v.contains(&eos_token_id) {
-                        Err(Error::EOSTokenDisallowed)
-                    } else {
-                        Ok((k.as_bytes().to_vec(), v))
-                    }
-                })
-                .collect::<Result<HashMap<Token, Vec<TokenId>>, _>>()?,
-        })
+            tokens.into_iter().map(|(k, v)| (k.into_bytes(), v)),
+        )
     }
 }
 
@@ -280,24 +455,32 @@ mod tests {
 
         for (token, id) in [("zero", 0), ("one", 1), ("two", 2)] {
             vocabulary.try_insert(token, id).expect("Insert failed");
-            assert_eq!(vocabulary.token_ids(token), Some(&vec![id]));
+            assert_eq!(vocabulary.token_ids(token), Some(&[id][..]));
         }
         assert_eq!(vocabulary.tokens.len(), 3);
         assert_eq!(vocabulary.tokens().len(), 3);
 
         // Confirm different types.
         vocabulary.try_insert(b"four", 4).expect("Insert failed");
-        assert_eq!(vocabulary.token_ids("four"), Some(&vec![4]));
+        assert_eq!(vocabulary.token_ids("four"), Some(&[4][..]));
 
         vocabulary
             .try_insert(b"five".to_vec(), 5)
             .expect("Insert failed");
-        assert_eq!(vocabulary.token_ids("five"), Some(&vec![5]));
+        assert_eq!(vocabulary.token_ids("five"), Some(&[5][..]));
 
         vocabulary
             .try_insert("six".to_string(), 6)
             .expect("Insert failed");
-        assert_eq!(vocabulary.token_ids("six"), Some(&vec![6]));
+        assert_eq!(vocabulary.token_ids("six"), Some(&[6][..]));
+
+        // Token ids are added to the token, wherever they are stored.
+        vocabulary.try_insert("zero", 7).expect("Insert failed");
+        assert_eq!(vocabulary.token_ids("zero"), Some(&[0, 7][..]));
+        vocabulary.try_insert("zero", 8).expect("Insert failed");
+        assert_eq!(vocabulary.token_ids("zero"), Some(&[0, 7, 8][..]));
+        assert_eq!(vocabulary.token_ids("one"), Some(&[1][..]));
+        assert_eq!(vocabulary.len(), 9);
 
         vocabulary.remove(b"four");
         assert_eq!(vocabulary.token_ids("four"), None);
@@ -307,6 +490,77 @@ mod tests {
 
         vocabulary.remove("six".to_string());
         assert_eq!(vocabulary.token_ids("six"), None);
+
+        // A removed token with several ids leaves its range of `ids` unused.
+        vocabulary.try_insert("one", 9).expect("Insert failed");
+        vocabulary.remove("one");
+        assert_eq!(vocabulary.ids.len(), 5);
+
+        // Compaction keeps only the ids of remaining tokens with several ids.
+        let before = vocabulary.clone();
+        assert!(matches!(before.compacted(), Cow::Owned(v) if v.ids.len() == 3));
+        vocabulary.compact();
+        assert!(matches!(vocabulary.compacted(), Cow::Borrowed(_)));
+        assert_eq!(vocabulary.ids.len(), 3);
+        assert_eq!(vocabulary, before);
+        assert_eq!(vocabulary.token_ids("zero"), Some(&[0, 7, 8][..]));
+    }
+
+    #[test]
+    fn insert_after_empty_ids() {
+        let tokens = [
+            (b"a".to_vec(), vec![]),
+            (b"b".to_vec(), vec![1, 2]),
+            (b"c".to_vec(), vec![]),
+        ];
+        let mut vocabulary = Vocabulary::try_from_tokens(3, tokens).expect("Vocabulary failed");
+        assert_eq!(vocabulary.token_ids("a"), Some(&[][..]));
+
+        // "c" has an empty range at the end of `ids`, "a" one in the middle.
+        vocabulary.try_insert("c", 5).expect("Insert failed");
+        assert_eq!(vocabulary.token_ids("c"), Some(&[5][..]));
+        vocabulary.try_insert("a", 4).expect("Insert failed");
+        assert_eq!(vocabulary.token_ids("a"), Some(&[4][..]));
+        vocabulary.try_insert("a", 6).expect("Insert failed");
+        assert_eq!(vocabulary.token_ids("a"), Some(&[4, 6][..]));
+        assert_eq!(vocabulary.token_ids("b"), Some(&[1, 2][..]));
+    }
+
+    #[test]
+    fn debug_shows_token_ids() {
+        let mut vocabulary = Vocabulary::new(3);
+        vocabulary.try_insert("a", 1).expect("Insert failed");
+        vocabulary.try_insert("a", 2).expect("Insert failed");
+        assert_eq!(
+            format!("{:?}", vocabulary),
+            "Vocabulary { eos_token_id: 3, tokens: {[97]: [1, 2]} }"
+        );
+    }
+
+    #[test]
+    fn content_hash() {
+        let mut vocabulary1 = Vocabulary::new(3);
+        let mut vocabulary2 = Vocabulary::new(3);
+        for (token, token_id) in [("a", 0), ("b", 1), ("c", 2)] {
+            vocabulary1
+                .try_insert(token, token_id)
+                .expect("Insert failed");
+        }
+        for (token, token_id) in [("c", 2), ("a", 0), ("b", 1)] {
+            vocabulary2
+                .try_insert(token, token_id)
+                .expect("Insert failed");
+        }
+        assert_eq!(vocabulary1, vocabulary2);
+        assert_eq!(vocabulary1.content_hash(), vocabulary2.content_hash());
+
+        vocabulary2.remove("c");
+        assert_ne!(vocabulary1.content_hash(), vocabulary2.content_hash());
+
+        assert_ne!(
+            Vocabulary::new(3).content_hash(),
+            Vocabulary::new(4).content_hash()
+        );
     }
 
     #[test]
@@ -1,9 +1,8 @@
 //! Post-processing operations for the tokens before they being inserted into
 //! `Vocabulary`, strategies depend on the tokenizer's level.
 
-use std::collections::HashMap;
-
 use once_cell::sync::Lazy;
+use rustc_hash::FxHashMap as HashMap;
 use serde::Deserialize;
 use tokenizers::normalizers::Replace;
 use tokenizers::{DecoderWrapper, Tokenizer};
@@ -69,7 +68,7 @@ use crate::{Error, Result};
 /// 'ÿ' == '\u{00FF}' -> 0xFF == 255
 /// ```
 static CHAR_MAP: Lazy<HashMap<char, u8>> = Lazy::new(|| {
-    let mut char_map = HashMap::with_capacity(256);
+    let mut char_map = HashMap::with_capacity_and_hasher(256, Default::default());
     let mut key = 0x100u32;
     for byte in 0..=255u8 {
         let char = byte as char;
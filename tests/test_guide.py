@@ -32,7 +32,7 @@ def test_interface():
 
     assert guide.advance(1) == [vocabulary.get_eos_token_id()]
     assert guide.is_finished()
-    assert guide.get_state() == 20
+    assert guide.get_state() == 16
     assert guide.get_tokens() == [eos_token_id]
 
     with pytest.raises(
@@ -204,6 +204,28 @@ def test_rollback_interface(index):
         guide.rollback_state(5)
 
 
+def test_rollback_limit():
+    vocabulary = Vocabulary(3, {"1": [1], "2": [2]})
+    index = Index(r"[1-9]+", vocabulary)
+
+    guide = Guide(index, max_rollback=1)
+    guide.advance(1)
+    guide.advance(2)
+    assert guide.get_allowed_rollback() == 1
+
+    # The limit survives pickling
+    guide = pickle.loads(pickle.dumps(guide))
+    guide.advance(1)
+    assert guide.get_allowed_rollback() == 1
+
+    # No state is kept without rollback
+    guide = Guide(index, max_rollback=0)
+    guide.advance(1)
+    assert guide.get_allowed_rollback() == 0
+    with pytest.raises(ValueError, match="Cannot roll back"):
+        guide.rollback_state(1)
+
+
 @pytest.mark.parametrize(
     "seq, expected",
     [
@@ -216,3 +238,138 @@ def test_rollback_interface(index):
 def test_accepts_tokens_correctness(index, seq, expected):
     guide = Guide(index)
     assert guide.accepts_tokens(seq) is expected
+
+
+def test_get_forced_token():
+    eos_token_id = 4
+    tokens = {"a": [0], "b": [1], "1": [2], "2": [3]}
+    regex = r"ab[0-9]"
+
+    vocabulary = Vocabulary(eos_token_id, tokens)
+    index = Index(regex, vocabulary)
+    guide = Guide(index)
+
+    assert guide.get_forced_token() == 0
+    guide.advance(0)
+    assert guide.get_forced_token() == 1
+    guide.advance(1)
+    # Several digits are allowed, nothing is forced
+    assert guide.get_forced_token() is None
+    guide.advance(2)
+    assert guide.get_forced_token() == eos_token_id
+
+
+def test_write_mask_into_batch():
+    import torch
+
+    from outlines_core.kernels.torch import allocate_token_bitmask
+
+    vocabulary = Vocabulary(3, {"1": [1], "2": [2]})
+    guides = [Guide(Index(r"[1-9]", vocabulary)), Guide(Index(r"2", vocabulary))]
+    guides[1].advance(2)
+
+    mask = allocate_token_bitmask(len(vocabulary) + 1, batch=len(guides))
+    assert mask.shape[0] == len(guides)
+    Guide.write_mask_into_batch(
+        guides, mask.data_ptr(), mask.numel(), mask.element_size()
+    )
+
+    for row, guide in zip(mask, guides):
+        single = torch.zeros_like(row)
+        guide.write_mask_into(single.data_ptr(), single.numel(), single.element_size())
+        assert torch.equal(row, single)
+
+    with pytest.raises(ValueError, match="Invalid batch size"):
+        Guide.write_mask_into_batch([], mask.data_ptr(), mask.numel(), 4)
+    with pytest.raises(ValueError, match="Invalid buffer size"):
+        Guide.write_mask_into_batch(guides, mask.data_ptr(), 3, 4)
+
+
+def test_advance_and_write_mask_batch():
+    import torch
+
+    from outlines_core.kernels.torch import allocate_token_bitmask
+
+    vocabulary = Vocabulary(3, {"1": [1], "2": [2]})
+    guides = [Guide(Index(r"[1-9]+", vocabulary)), Guide(Index(r"22", vocabulary))]
+
+    mask = allocate_token_bitmask(len(vocabulary) + 1, batch=len(guides))
+    Guide.advance_and_write_mask_batch(
+        guides, [1, 2], mask.data_ptr(), mask.numel(), mask.element_size()
+    )
+    assert [guide.get_allowed_rollback() for guide in guides] == [1, 1]
+
+    for row, guide in zip(mask, guides):
+        single = torch.zeros_like(row)
+        guide.write_mask_into(single.data_ptr(), single.numel(), single.element_size())
+        assert torch.equal(row, single)
+
+    # No guide is advanced if one of the tokens isn't allowed
+    states = [guide.get_state() for guide in guides]
+    with pytest.raises(ValueError, match="No next state found"):
+        Guide.advance_and_write_mask_batch(
+            guides, [2, 1], mask.data_ptr(), mask.numel(), mask.element_size()
+        )
+    assert [guide.get_state() for guide in guides] == states
+
+    with pytest.raises(ValueError, match="Invalid batch size"):
+        Guide.advance_and_write_mask_batch(guides, [2], mask.data_ptr(), 4, 4)
+
+
+def test_mask_logits_into(index):
+    import torch
+
+    guide = Guide(index)
+    logits = torch.zeros(8)
+    guide.mask_logits_into(logits.data_ptr(), logits.numel(), logits.element_size())
+
+    allowed = set(guide.get_tokens())
+    for token_id, logit in enumerate(logits.tolist()):
+        assert (logit == 0) == (token_id in allowed)
+
+    with pytest.raises(ValueError, match="Invalid element size"):
+        guide.mask_logits_into(logits.data_ptr(), logits.numel(), 2)
+    with pytest.raises(ValueError, match="Invalid data pointer"):
+        guide.mask_logits_into(0, logits.numel(), logits.element_size())
+
+
+def test_advance_into(index):
+    import numpy as np
+
+    guide = Guide(index)
+    expected_guide = Guide(index)
+    tokens = np.zeros(4, dtype=np.uint32)
+
+    # An invalid buffer leaves the guide in place
+    state = guide.get_state()
+    with pytest.raises(ValueError, match="Invalid buffer size"):
+        guide.advance_into(1, tokens.ctypes.data, 0, tokens.itemsize)
+    assert guide.get_state() == state
+
+    count = guide.advance_into(1, tokens.ctypes.data, tokens.size, tokens.itemsize)
+    expected = expected_guide.advance(1)
+
+    assert guide.get_state() == expected_guide.get_state()
+    assert sorted(tokens[:count].tolist()) == sorted(expected)
+
+
+def test_advance_and_write_mask(index):
+    import torch
+
+    guide = Guide(index)
+    expected_guide = Guide(index)
+    mask = torch.tensor([-1], dtype=torch.int32)
+    expected = torch.tensor([-1], dtype=torch.int32)
+
+    guide.advance_and_write_mask(1, mask.data_ptr(), mask.numel(), 4)
+    expected_guide.advance(1, return_tokens=False)
+    expected_guide.write_mask_into(expected.data_ptr(), expected.numel(), 4)
+
+    assert guide.get_state() == expected_guide.get_state()
+    assert torch.equal(mask, expected)
+
+    # An invalid buffer leaves the guide in place
+    state = guide.get_state()
+    with pytest.raises(ValueError, match="Invalid element size"):
+        guide.advance_and_write_mask(3, mask.data_ptr(), mask.numel(), 8)
+    assert guide.get_state() == state
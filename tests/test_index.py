@@ -26,20 +26,23 @@ def test_basic_interface(index):
     assert allowed_tokens == [1, 2]
 
     next_state = index.get_next_state(init_state, allowed_tokens[-1])
-    assert next_state == 20
+    assert next_state == 16
     assert index.is_final_state(next_state) is True
-    assert index.get_final_states() == {20}
+    assert index.get_final_states() == {16}
 
     expected_transitions = {
         12: {
-            1: 20,
-            2: 20,
+            1: 16,
+            2: 16,
         },
-        20: {
-            3: 20,
+        16: {
+            3: 16,
         },
     }
     assert index.get_transitions() == expected_transitions
+    for state, transitions in expected_transitions.items():
+        assert index.get_state_transitions(state) == transitions
+    assert index.get_state_transitions(init_state + 1) is None
 
 
 def test_pickling(index):
@@ -62,3 +65,44 @@ def test_deepcopy(index):
     assert is_deleted
 
     assert copy_index2 == index
+
+
+def test_index_cache():
+    from outlines_core import IndexCache, get_or_build_index
+
+    vocabulary = Vocabulary(3, {"1": [1], "2": [2]})
+    cache = IndexCache(maxsize=2)
+
+    index = cache.get_or_build(r"[1-9]", vocabulary)
+    assert cache.get_or_build(r"[1-9]", vocabulary) is index
+    assert len(cache) == 1
+
+    # Same pattern, equal vocabulary: the entry is shared
+    assert cache.get_or_build(r"[1-9]", Vocabulary(3, {"2": [2], "1": [1]})) is index
+    assert len(cache) == 1
+
+    # Same pattern, different vocabulary: a distinct entry
+    other_vocabulary = Vocabulary(3, {"1": [1], "2": [2], "3": [4]})
+    other_index = cache.get_or_build(r"[1-9]", other_vocabulary)
+    assert other_index is not index
+    assert len(cache) == 2
+
+    # Modifying a vocabulary in place doesn't return stale indexes
+    other_vocabulary.remove("3")
+    assert cache.get_or_build(r"[1-9]", other_vocabulary) is index
+
+    # The least recently used entry is evicted
+    cache.get_or_build(r"[1-2]", vocabulary)
+    assert len(cache) == 2
+    other_vocabulary.insert("3", 4)
+    assert cache.get_or_build(r"[1-9]", other_vocabulary) is not other_index
+
+    cache.clear()
+    assert len(cache) == 0
+
+    assert get_or_build_index(r"[1-9]", vocabulary) is get_or_build_index(
+        r"[1-9]", vocabulary
+    )
+
+    with pytest.raises(ValueError, match="Invalid cache size"):
+        IndexCache(maxsize=0)
@@ -24,6 +24,16 @@ def test_build_regex_from_json_schema():
     assert re.fullmatch(regex, expected)
 
 
+def test_build_regex_from_json_schema_memoized():
+    schema = json.dumps({"type": "object", "properties": {"a": {"type": "integer"}}})
+
+    regex = build_regex_from_schema(schema)
+    assert build_regex_from_schema(schema) == regex
+    # The whitespace pattern is part of the key
+    assert build_regex_from_schema(schema, r"[\n ]*") != regex
+    assert build_regex_from_schema(schema) == regex
+
+
 def test_invalid_json():
     with pytest.raises(
         TypeError,
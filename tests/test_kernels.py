@@ -6,17 +6,36 @@ import torch
 
 from outlines_core import Guide, Index, Vocabulary
 
-VOCAB = Vocabulary.from_pretrained("gpt2", None, None)
-VOCAB_LEN = len(VOCAB)
+# Size of the gpt2 vocabulary, checked against it in `test_vocab_len`. Tests
+# which only need the size don't load the vocabulary.
+VOCAB_LEN = 50257
 
 
 @pytest.fixture(scope="session")
-def guide() -> Guide:
-    return Guide(Index("\\+?[1-9][0-9]{7,14}", VOCAB))
+def vocabulary() -> Vocabulary:
+    return Vocabulary.from_pretrained("gpt2", None, None)
+
+
+@pytest.fixture(scope="session")
+def guide(vocabulary) -> Guide:
+    return Guide(Index("\\+?[1-9][0-9]{7,14}", vocabulary))
+
+
+@pytest.fixture(scope="session")
+def allowed(guide) -> np.ndarray:
+    # Whether each token is allowed in the state of `guide`, which tests don't advance.
+    allowed = np.zeros(VOCAB_LEN, dtype=bool)
+    allowed[guide.get_tokens()] = True
+    allowed.flags.writeable = False
+    return allowed
+
+
+def test_vocab_len(vocabulary):
+    assert len(vocabulary) == VOCAB_LEN
 
 
 @pytest.mark.no_cover
-def test_interface_torch():
+def test_interface_torch(guide):
     from outlines_core.kernels.torch import (
         allocate_token_bitmask,
         apply_token_bitmask_inplace,
@@ -67,9 +86,17 @@ def test_interface_torch():
     ):
         fill_next_token_bitmask(None, mask_batch2)
 
+    with pytest.raises(ValueError, match="to match the number of guides"):
+        fill_next_token_bitmask([guide], mask_batch2)
+
+    fill_next_token_bitmask([guide, guide], mask_batch2)
+    fill_next_token_bitmask(guide, mask)
+    assert torch.equal(mask_batch2[0], mask[0])
+    assert torch.equal(mask_batch2[1], mask[0])
+
 
 @pytest.mark.no_cover
-def test_interface_numpy():
+def test_interface_numpy(guide):
     from outlines_core.kernels.numpy import (
         allocate_token_bitmask,
         apply_token_bitmask_inplace,
@@ -118,12 +145,20 @@ def test_interface_numpy():
     ):
         fill_next_token_bitmask(None, mask_batch2)
 
+    with pytest.raises(ValueError, match="to match the number of guides"):
+        fill_next_token_bitmask([guide], mask_batch2)
+
+    fill_next_token_bitmask([guide, guide], mask_batch2)
+    fill_next_token_bitmask(guide, mask)
+    assert np.array_equal(mask_batch2[0], mask[0])
+    assert np.array_equal(mask_batch2[1], mask[0])
+
 
 @pytest.mark.no_cover
 @pytest.mark.skipif(
     not importlib.util.find_spec("mlx"), reason="mlx is required to test mlx kernels"  # type: ignore
 )
-def test_interface_mlx():
+def test_interface_mlx(guide):
     import mlx.core as mx
     import numpy as np
     import pytest
@@ -175,44 +210,39 @@ def test_interface_mlx():
     ):
         fill_next_token_bitmask(None, mask_batch2)
 
+    with pytest.raises(ValueError, match="to match the number of guides"):
+        fill_next_token_bitmask([guide], mask_batch2)
 
-@pytest.mark.no_cover
-def test_torch_correctness(guide):
-    from outlines_core.kernels.torch import _apply_token_bitmask_inplace_kernel
+    fill_next_token_bitmask([guide, guide], mask_batch2)
+    fill_next_token_bitmask(guide, mask)
+    assert np.array_equal(mask_batch2[0], mask[0])
+    assert np.array_equal(mask_batch2[1], mask[0])
 
-    allowed_tokens = set(guide.get_tokens())
 
-    logits = torch.tensor(torch.randn(1, VOCAB_LEN))
+@pytest.mark.no_cover
+def test_torch_correctness(guide, allowed):
+    from outlines_core.kernels.torch import _apply_token_bitmask_inplace_kernel
 
-    orig_logits = logits.clone()
+    logits = torch.randn(1, VOCAB_LEN)
+    expected = logits.clone()
+    expected[0, ~torch.tensor(allowed)] = -torch.inf
 
-    mask = torch.tensor(
-        torch.full((1, ((VOCAB_LEN + 31) // 32)), -1, dtype=torch.int32)
-    )
+    mask = torch.full((1, ((VOCAB_LEN + 31) // 32)), -1, dtype=torch.int32)
 
     guide.write_mask_into(mask.data_ptr(), mask.numel(), mask.element_size())
 
     _apply_token_bitmask_inplace_kernel(logits, mask)
 
-    for j in range(VOCAB_LEN):
-        if j in allowed_tokens:
-            assert torch.isclose(
-                logits[0, j], orig_logits[0, j], equal_nan=True
-            ), f"Token {j} should be allowed but was masked."
-        else:
-            assert logits[0, j] == -float(
-                "inf"
-            ), f"Token {j} should be masked but was {logits[0, j].item()}."
+    assert torch.equal(logits, expected)
 
 
 @pytest.mark.no_cover
-def test_numpy_correctness(guide):
+def test_numpy_correctness(guide, allowed):
     from outlines_core.kernels.numpy import _apply_token_bitmask_inplace_kernel
 
-    allowed_tokens = set(guide.get_tokens())
-
     logits = np.random.randn(1, VOCAB_LEN).astype(np.float32)
-    orig_logits = logits.copy()
+    expected = logits.copy()
+    expected[0, ~allowed] = -np.inf
 
     mask = np.full((1, ((VOCAB_LEN + 31) // 32)), -1, dtype=np.int32)
 
@@ -220,33 +250,21 @@ def test_numpy_correctness(guide):
 
     _apply_token_bitmask_inplace_kernel(logits, mask)
 
-    for j in range(VOCAB_LEN):
-        if j in allowed_tokens:
-            np.testing.assert_allclose(
-                logits[0, j],
-                orig_logits[0, j],
-                err_msg=f"Token {j} should be allowed but was masked.",
-            )
-        else:
-            assert (
-                logits[0, j] == -np.inf
-            ), f"Token {j} should be masked was got {logits[0, j]}."
+    np.testing.assert_array_equal(logits, expected)
 
 
 @pytest.mark.no_cover
 @pytest.mark.skipif(
     not importlib.util.find_spec("mlx"), reason="mlx is required to test mlx kernels"  # type: ignore
 )
-def test_mlx_correctness(guide):
+def test_mlx_correctness(guide, allowed):
     import mlx.core as mx
 
     from outlines_core.kernels.mlx import _apply_token_bitmask_kernel
 
-    allowed_tokens = set(guide.get_tokens())
-
     np_logits = np.random.randn(1, VOCAB_LEN).astype(np.float32)
-
-    orig_logits = np_logits.copy()
+    expected = np_logits.copy()
+    expected[0, ~allowed] = -np.inf
 
     logits_mlx = mx.array(np_logits)
 
@@ -256,16 +274,329 @@ def test_mlx_correctness(guide):
 
     logits_mlx_out = _apply_token_bitmask_kernel(logits_mlx, mx.array(mask))
 
-    logits_out = np.array(logits_mlx_out)
-
-    for j in range(VOCAB_LEN):
-        if j in allowed_tokens:
-            np.testing.assert_allclose(
-                logits_out[0, j],
-                orig_logits[0, j],
-                err_msg=f"Token {j} should be allowed but was masked.",
-            )
-        else:
-            assert (
-                logits_out[0, j] == -np.inf
-            ), f"Token {j} should be masked was got {logits_out[0, j]}."
+    np.testing.assert_array_equal(np.array(logits_mlx_out), expected)
+
+
+@pytest.mark.no_cover
+def test_torch_logits_wider_than_mask():
+    from outlines_core.kernels.torch import _apply_token_bitmask_inplace_kernel
+
+    logits = torch.randn(2, 100)
+    orig_logits = logits.clone()
+    mask = torch.full((2, 2), -1, dtype=torch.int32)
+    mask[1, 0] = 0
+
+    _apply_token_bitmask_inplace_kernel(logits, mask)
+
+    assert torch.equal(logits[0, :64], orig_logits[0, :64])
+    assert torch.all(logits[1, :32] == -float("inf"))
+    assert torch.equal(logits[1, 32:64], orig_logits[1, 32:64])
+    assert torch.all(logits[:, 64:] == -float("inf"))
+
+
+@pytest.mark.no_cover
+def test_torch_fill_and_upload(guide):
+    from outlines_core.kernels.torch import (
+        allocate_token_bitmask,
+        fill_next_token_bitmask,
+        fill_next_token_bitmask_and_upload,
+    )
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    mask = allocate_token_bitmask(VOCAB_LEN)
+    device_mask = torch.empty_like(mask, device=device)
+
+    with pytest.raises(ValueError, match="Invalid device mask"):
+        fill_next_token_bitmask_and_upload(guide, mask, device_mask[:, :-1])
+
+    fill_next_token_bitmask_and_upload(guide, mask, device_mask)
+    if device == "cuda":
+        torch.cuda.current_stream().synchronize()
+
+    expected = allocate_token_bitmask(VOCAB_LEN)
+    fill_next_token_bitmask(guide, expected)
+    assert torch.equal(device_mask.cpu(), expected)
+
+
+@pytest.mark.no_cover
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA is required")
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+def test_torch_cuda_kernel_correctness(guide, dtype):
+    from outlines_core.kernels.torch import (
+        _apply_token_bitmask_inplace_kernel,
+        _load_cuda_kernel,
+    )
+
+    cuda_kernel = _load_cuda_kernel()
+    if cuda_kernel is None:
+        pytest.skip("CUDA kernel could not be compiled")
+
+    mask = torch.full((1, (VOCAB_LEN + 31) // 32), -1, dtype=torch.int32)
+    guide.write_mask_into(mask.data_ptr(), mask.numel(), mask.element_size())
+    mask = mask.cuda()
+
+    logits = torch.randn(1, VOCAB_LEN, device="cuda", dtype=dtype)
+    expected = logits.clone()
+
+    cuda_kernel.apply_token_bitmask_inplace(logits, mask)
+    _apply_token_bitmask_inplace_kernel(expected, mask)
+
+    assert torch.equal(logits, expected)
+
+
+def test_torch_cuda_kernel_build_failure(monkeypatch):
+    import torch.utils.cpp_extension
+
+    from outlines_core.kernels.torch import _load_cuda_kernel, load_cuda_kernel
+
+    def load_inline(*args, **kwargs):
+        raise RuntimeError("nvcc not found")
+
+    monkeypatch.setattr(torch.utils.cpp_extension, "load_inline", load_inline)
+    _load_cuda_kernel.cache_clear()
+    try:
+        with pytest.warns(RuntimeWarning, match="nvcc not found"):
+            assert not load_cuda_kernel()
+    finally:
+        _load_cuda_kernel.cache_clear()
+
+
+@pytest.mark.no_cover
+@pytest.mark.skipif(
+    not importlib.util.find_spec("mlx"), reason="mlx is required to test mlx kernels"  # type: ignore
+)
+def test_mlx_apply_accepts_mx_mask(guide):
+    import mlx.core as mx
+
+    from outlines_core.kernels.mlx import apply_token_bitmask
+
+    mask = np.full((1, (VOCAB_LEN + 31) // 32), -1, dtype=np.int32)
+    guide.write_mask_into(mask.ctypes.data, mask.size, mask.itemsize)
+
+    logits = mx.array(np.random.randn(1, VOCAB_LEN).astype(np.float32))
+
+    from_np = np.array(apply_token_bitmask(logits, mask))
+    from_mx = np.array(apply_token_bitmask(logits, mx.array(mask)))
+    np.testing.assert_array_equal(from_np, from_mx)
+    from_keyword = np.array(apply_token_bitmask(logits, mask_np=mask))
+    np.testing.assert_array_equal(from_np, from_keyword)
+
+
+@pytest.mark.no_cover
+@pytest.mark.parametrize(
+    "dtype", [torch.float32, torch.float16, torch.bfloat16, torch.int8]
+)
+def test_torch_correctness_dtypes(guide, allowed, dtype):
+    from outlines_core.kernels.torch import apply_token_bitmask_inplace
+
+    mask = torch.full((1, (VOCAB_LEN + 31) // 32), -1, dtype=torch.int32)
+    guide.write_mask_into(mask.data_ptr(), mask.numel(), mask.element_size())
+
+    logits = (10 * torch.randn(1, VOCAB_LEN)).to(dtype)
+    expected = logits.float()
+    fill = -torch.inf if dtype.is_floating_point else torch.iinfo(dtype).min
+    expected[0, ~torch.tensor(allowed)] = fill
+
+    apply_token_bitmask_inplace(logits, mask)
+
+    assert logits.dtype == dtype
+    assert torch.equal(logits.float(), expected)
+
+
+@pytest.mark.no_cover
+@pytest.mark.parametrize(
+    "dtype",
+    [np.float16, np.float32, np.float64, np.int8, np.longdouble, np.complex128],
+)
+def test_numpy_correctness_dtypes(guide, allowed, dtype):
+    from outlines_core.kernels.numpy import apply_token_bitmask_inplace
+
+    mask = np.full((1, (VOCAB_LEN + 31) // 32), -1, dtype=np.int32)
+    guide.write_mask_into(mask.ctypes.data, mask.size, mask.itemsize)
+
+    logits = (10 * np.random.randn(1, VOCAB_LEN)).astype(dtype)
+    expected = logits.copy()
+    fill = np.iinfo(dtype).min if np.issubdtype(dtype, np.integer) else -np.inf
+    expected[0, ~allowed] = fill
+
+    apply_token_bitmask_inplace(logits, mask)
+
+    assert logits.dtype == dtype
+    np.testing.assert_array_equal(logits, expected)
+
+
+@pytest.mark.no_cover
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16])
+def test_torch_unaligned_logits(guide, allowed, dtype):
+    from outlines_core.kernels.torch import apply_token_bitmask_inplace
+
+    mask = torch.full((1, (VOCAB_LEN + 31) // 32), -1, dtype=torch.int32)
+    guide.write_mask_into(mask.data_ptr(), mask.numel(), mask.element_size())
+
+    # A view of a buffer at an odd offset, which the native kernel can't mask.
+    buffer = bytearray(VOCAB_LEN * dtype.itemsize + 1)
+    logits = torch.frombuffer(buffer, dtype=dtype, offset=1).view(1, VOCAB_LEN)
+    logits.copy_(torch.randn(1, VOCAB_LEN))
+    expected = logits.clone()
+    expected[0, ~torch.tensor(allowed)] = -torch.inf
+
+    apply_token_bitmask_inplace(logits, mask)
+
+    assert torch.equal(logits, expected)
+
+
+@pytest.mark.no_cover
+@pytest.mark.parametrize("dtype", [np.float32, np.float16])
+def test_numpy_unaligned_logits(guide, allowed, dtype):
+    from outlines_core.kernels.numpy import apply_token_bitmask_inplace, fill_and_apply
+
+    mask = np.full((1, (VOCAB_LEN + 31) // 32), -1, dtype=np.int32)
+    guide.write_mask_into(mask.ctypes.data, mask.size, mask.itemsize)
+
+    # A view of a buffer at an odd offset, which the native kernel can't mask.
+    buffer = bytearray(VOCAB_LEN * np.dtype(dtype).itemsize + 1)
+    logits = np.frombuffer(buffer, dtype=dtype, offset=1).reshape(1, VOCAB_LEN)
+    assert not logits.flags["ALIGNED"]
+    logits[:] = np.random.randn(1, VOCAB_LEN)
+    expected = logits.copy()
+    expected[0, ~allowed] = -np.inf
+
+    apply_token_bitmask_inplace(logits, mask)
+    np.testing.assert_array_equal(logits, expected)
+
+    fill_and_apply(guide, logits)
+    np.testing.assert_array_equal(logits, expected)
+
+
+@pytest.mark.no_cover
+@pytest.mark.skipif(
+    not importlib.util.find_spec("mlx"), reason="mlx is required to test mlx kernels"  # type: ignore
+)
+def test_mlx_correctness_bfloat16(guide):
+    import mlx.core as mx
+
+    from outlines_core.kernels.mlx import apply_token_bitmask
+
+    mask = np.full((1, (VOCAB_LEN + 31) // 32), -1, dtype=np.int32)
+    guide.write_mask_into(mask.ctypes.data, mask.size, mask.itemsize)
+
+    logits = mx.array(np.random.randn(1, VOCAB_LEN).astype(np.float32))
+    expected = np.array(apply_token_bitmask(logits, mask))
+
+    out = apply_token_bitmask(logits.astype(mx.bfloat16), mask)
+
+    assert out.dtype == mx.bfloat16
+    np.testing.assert_array_equal(
+        np.array(out.astype(mx.float32)) == -np.inf, expected == -np.inf
+    )
+
+
+@pytest.mark.no_cover
+@pytest.mark.parametrize("dtype", [np.float32, np.float64, np.float16, np.int8])
+def test_numpy_unpacked_matches_kernel(dtype):
+    from outlines_core.kernels.numpy import (
+        _apply_token_bitmask_inplace_kernel,
+        _apply_token_bitmask_inplace_unpacked,
+    )
+
+    rng = np.random.default_rng(0)
+    for vocab_size in (100, 128, 200):
+        mask = rng.integers(-(2**31), 2**31, (2, 4)).astype(np.int32)
+        mask[0, 1] = -1
+        logits = rng.standard_normal((2, vocab_size)).astype(dtype)
+        expected = logits.copy()
+
+        _apply_token_bitmask_inplace_kernel(expected, mask)
+        _apply_token_bitmask_inplace_unpacked(logits, mask)
+
+        np.testing.assert_array_equal(logits, expected)
+
+
+@pytest.mark.no_cover
+@pytest.mark.skipif(
+    not importlib.util.find_spec("mlx"), reason="mlx is required to test mlx kernels"  # type: ignore
+)
+def test_mlx_make_apply_kernel(guide):
+    import mlx.core as mx
+
+    from outlines_core.kernels.mlx import apply_token_bitmask, make_apply_kernel
+
+    mask = np.full((1, (VOCAB_LEN + 31) // 32), -1, dtype=np.int32)
+    guide.write_mask_into(mask.ctypes.data, mask.size, mask.itemsize)
+
+    logits = mx.array(np.random.randn(1, VOCAB_LEN).astype(np.float32))
+    kernel = make_apply_kernel(1, VOCAB_LEN, mx.float32)
+
+    np.testing.assert_array_equal(
+        np.array(kernel(logits, mx.array(mask))),
+        np.array(apply_token_bitmask(logits, mask)),
+    )
+
+
+@pytest.mark.no_cover
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float64, torch.float16])
+def test_torch_fill_and_apply(guide, allowed, dtype):
+    from outlines_core.kernels.torch import fill_and_apply
+
+    logits = torch.randn(1, VOCAB_LEN, dtype=dtype)
+    expected = logits.clone()
+    expected[0, ~torch.tensor(allowed)] = -torch.inf
+
+    fill_and_apply(guide, logits)
+    assert torch.equal(logits, expected)
+
+    logits_1d = expected[0].clone()
+    fill_and_apply(guide, logits_1d)
+    assert torch.equal(logits_1d, expected[0])
+
+    with pytest.raises(ValueError, match="Invalid batch size"):
+        fill_and_apply(guide, torch.randn(2, VOCAB_LEN, dtype=dtype))
+
+
+@pytest.mark.no_cover
+@pytest.mark.parametrize("dtype", [np.float32, np.float64, np.float16])
+def test_numpy_fill_and_apply(guide, allowed, dtype):
+    from outlines_core.kernels.numpy import fill_and_apply
+
+    logits = np.random.randn(1, VOCAB_LEN).astype(dtype)
+    expected = logits.copy()
+    expected[0, ~allowed] = -np.inf
+
+    fill_and_apply(guide, logits)
+    np.testing.assert_array_equal(logits, expected)
+
+    logits_1d = expected[0].copy()
+    fill_and_apply(guide, logits_1d)
+    np.testing.assert_array_equal(logits_1d, expected[0])
+
+    with pytest.raises(ValueError, match="Invalid batch size"):
+        fill_and_apply(guide, np.random.randn(2, VOCAB_LEN).astype(dtype))
+
+
+@pytest.mark.no_cover
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_numpy_sample_next_token(guide, allowed, dtype):
+    from outlines_core.kernels.numpy import sample_next_token
+
+    tokens = np.flatnonzero(allowed)
+    probs = np.random.rand(VOCAB_LEN).astype(dtype)
+    probs[tokens[0]] = 0
+    probs /= probs.sum()
+
+    # Inverse of the cdf of the masked probabilities, walked by increasing token id.
+    cdf = np.cumsum(probs[tokens], dtype=np.float64)
+    for seed in range(20):
+        u = np.random.default_rng(seed).random()
+        expected = tokens[np.searchsorted(cdf, u * cdf[-1], side="right")]
+        token = sample_next_token(guide, probs, np.random.default_rng(seed))
+        assert token == expected
+        assert token != tokens[0]
+
+    with pytest.raises(ValueError, match="positive weight"):
+        sample_next_token(
+            guide, np.zeros(VOCAB_LEN, dtype=dtype), np.random.default_rng()
+        )
+    with pytest.raises(ValueError, match="Invalid probabilities dimensions"):
+        sample_next_token(guide, probs.reshape(1, -1), np.random.default_rng())
+    with pytest.raises(ValueError, match="Invalid probabilities dtype"):
+        sample_next_token(guide, probs.astype(np.float16), np.random.default_rng())
@@ -19,14 +19,17 @@ def test_generate_length():
             self.rng = np.random.default_rng(_seed)
             self.prob = _prob
             self.p0 = _p0
-            self.states = _states
+            self.states = np.array(_states)
+            # Reused by every call for the masked and normalized probabilities.
+            self.masked = np.empty(len(_states))
 
         def __call__(
             self, tokens: Optional[List[int]], *, mask: List[int]
         ) -> List[int]:
             prob = self.prob(tokens) if tokens is not None else self.p0
-            prob = prob * np.array(mask)
-            next_t = [self.rng.choice(self.states, p=prob / np.sum(prob))]
+            np.multiply(prob, mask, out=self.masked)
+            self.masked /= self.masked.sum()
+            next_t = [self.rng.choice(self.states, p=self.masked)]
             return tokens + next_t if tokens is not None else next_t
 
     def generate(model, regex_str) -> Optional[List[int]]:
@@ -37,12 +40,17 @@ def test_generate_length():
         n_tokens = len(vocabulary)  # include eos token in count
         tokens = None
         allowed = guide.get_tokens()
+        # Reused by every step, `advance_into` writes the allowed tokens into it.
+        buffer = np.zeros(n_tokens, dtype=np.uint32)
         while True:
             mask: List[int] = [1 if s in allowed else 0 for s in range(1, n_tokens + 1)]
             tokens = model(tokens, mask=mask)
             if tokens[-1] == 3:
                 break
-            allowed = guide.advance(tokens[-1])
+            count = guide.advance_into(
+                tokens[-1], buffer.ctypes.data, buffer.size, buffer.itemsize
+            )
+            allowed = buffer[:count]
         return tokens
 
     def prob_non_markov(tokens: List[int]) -> np.array:
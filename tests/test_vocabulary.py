@@ -1,5 +1,8 @@
 import copy
+import os
 import pickle
+import subprocess
+import sys
 
 import pytest
 
@@ -38,6 +41,19 @@ def test_basic_vocabulary_interface(vocabulary):
     assert vocabulary.get("a") is None
 
 
+def test_insert_after_empty_token_ids():
+    vocabulary = Vocabulary(3, {"a": [], "b": [1, 2], "c": []})
+    assert vocabulary.get("a") == []
+
+    vocabulary.insert("a", 5)
+    assert vocabulary.get("a") == [5]
+    vocabulary.insert("c", 6)
+    assert vocabulary.get("c") == [6]
+    vocabulary.insert("a", 7)
+    assert vocabulary.get("a") == [5, 7]
+    assert vocabulary.get("b") == [1, 2]
+
+
 def test_string_and_bytes_as_tokens():
     eos_token_id = 3
     tokens = {"1": [1], "a": [2]}
@@ -68,6 +84,18 @@ def test_do_not_supports_other_types():
     ):
         Vocabulary(eos_token_id, {1: [1], 2: [2]})
 
+    with pytest.raises(
+        TypeError,
+        match="Dict keys or/and values of the wrong types",
+    ):
+        Vocabulary(eos_token_id, {"1": [1], b"2": [2]})
+
+    with pytest.raises(
+        TypeError,
+        match="Dict keys or/and values of the wrong types",
+    ):
+        Vocabulary(eos_token_id, {"1": [1], "2": "2"})
+
 
 def test_get_bad_type(vocabulary):
     with pytest.raises(
@@ -97,6 +125,52 @@ def test_from_pretrained():
     assert vocabulary.get_eos_token_id() == 50256
 
 
+def _from_pretrained_in_new_process(revision, env):
+    # Vocabularies are also memoized in process, so the disk cache is only
+    # used by a new process.
+    code = (
+        "from outlines_core import Vocabulary; "
+        f"print(len(Vocabulary.from_pretrained('gpt2', {revision!r})))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True
+    )
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.strip() == "50257"
+
+
+def test_from_pretrained_disk_cache(tmp_path):
+    huggingface_hub = pytest.importorskip("huggingface_hub")
+    commit = huggingface_hub.model_info("gpt2").sha
+    env = {k: v for k, v in os.environ.items() if k != "OUTLINES_CORE_CACHE_DIR"}
+
+    # Disabled unless OUTLINES_CORE_CACHE_DIR is set, whatever the home and
+    # cache directories. The Hugging Face cache is kept in place.
+    home = tmp_path / "home"
+    home.mkdir()
+    hf_home = env.get("HF_HOME", os.path.expanduser("~/.cache/huggingface"))
+    _from_pretrained_in_new_process(
+        commit,
+        {**env, "HOME": str(home), "XDG_CACHE_HOME": str(home), "HF_HOME": hf_home},
+    )
+    assert list(home.iterdir()) == []
+
+    # A miss writes the cache file.
+    cache_dir = tmp_path / "cache"
+    env["OUTLINES_CORE_CACHE_DIR"] = str(cache_dir)
+    _from_pretrained_in_new_process(commit, env)
+    (cache_file,) = cache_dir.iterdir()
+    inode = cache_file.stat().st_ino
+
+    # A hit reads it, without building the vocabulary and writing it again.
+    _from_pretrained_in_new_process(commit, env)
+    assert [(f, f.stat().st_ino) for f in cache_dir.iterdir()] == [(cache_file, inode)]
+
+    # A moving revision isn't cached on disk, where it would be served stale.
+    _from_pretrained_in_new_process("main", env)
+    assert list(cache_dir.iterdir()) == [cache_file]
+
+
 def test_pickling(vocabulary):
     serialized = pickle.dumps(vocabulary)
     deserialized = pickle.loads(serialized)
@@ -115,3 +189,19 @@ def test_deepcopy(vocabulary):
     assert len(vocabulary2) - 1 == len(copy_vocabulary2)
     assert copy_vocabulary2 == vocabulary
     assert len(copy_vocabulary2) == len(vocabulary)
+
+
+def test_vocabulary_hash():
+    vocabulary = Vocabulary(3, {"1": [1], "2": [2]})
+    assert hash(vocabulary) == hash(Vocabulary(3, {"2": [2], "1": [1]}))
+    assert hash(vocabulary) != hash(Vocabulary(4, {"1": [1], "2": [2]}))
+
+    # The cached hash follows the modifications of the vocabulary, not of its copies.
+    copied = copy.deepcopy(vocabulary)
+    assert copied == vocabulary and hash(copied) == hash(vocabulary)
+    before = hash(vocabulary)
+    vocabulary.insert("3", 4)
+    assert hash(vocabulary) != before
+    assert hash(copied) == before and copied != vocabulary
+    vocabulary.remove("3")
+    assert hash(vocabulary) == before and copied == vocabulary